@@ -55,6 +55,8 @@ class Gameboard(object):
         .word_loc(word) [int, int] : returns the x, y location of the word
         .unguessed_words(team_num) [list[str]] : returns a list of the words that have not yet been guessed
         .remaining(team_num) [int] : Counts how many cards are left for the given team
+        .from_arrays(boardwords, boardkey, boardmarkers) [Gameboard] : (classmethod) Recreates a gameboard from its
+            arrays, e.g. after it has been sent via the API
     """
     def __init__(self, wordlist):
         """
@@ -70,15 +72,37 @@ class Gameboard(object):
         self.boardmarkers = np.zeros((5,5))
         self.boardmarkers[:] = np.NaN
 
+    @classmethod
+    def from_arrays(cls, boardwords, boardkey, boardmarkers):
+        """
+        Recreates a gameboard from its arrays, e.g. after it has been sent via the API. Unlike instantiating a new
+            gameboard, nothing is generated at random
+
+        @param boardwords (5x5 np.array[str]): the 5x5 grid of words
+        @param boardkey (5x5 np.array[int]): the key that tells which words belong to which team
+        @param boardmarkers (5x5 np.array[float]): the array that tracks which words have been tapped
+
+        @returns gameboard (Gameboard): the recreated gameboard
+        """
+        gameboard = cls.__new__(cls)
+        gameboard.boardwords = boardwords
+        gameboard.boardkey = boardkey
+        gameboard.boardmarkers = boardmarkers
+        return gameboard
+
     def generate_board(self, wordlist):
         """
         Generates the array and fills it with a random subset of words from the wordlist
 
-        @param wordlist (list[str]): the list of words from which to generate the board
+        @param wordlist (list[str] or np.array[str]): the list of words from which to generate the board. Passing an
+            np.array saves converting the list on every call
 
         @returns words (5x5 np.array): the board of words
         """
-        words = np.random.choice(wordlist, size=(5,5), replace=False)
+        # pick the 25 indices first so only those words (rather than the whole wordlist) are copied. This draws from the
+        # same np.random state (and so gives the same board for a given np.random.seed) as choosing the words directly:
+        word_indices = np.random.choice(len(wordlist), size=25, replace=False)
+        words = np.asarray(wordlist)[word_indices].reshape((5,5))
         return words
 
     def generate_key(self):
@@ -200,6 +224,9 @@ class Game(object):
                                                      'Elo after update'  : {'Spymaster': [float],
                                                                             'Operative': [float]}}
         .game_start_time [datetime] : when the game started
+        .version [int] : incremented every time the state of the game changes (a clue or guesses are given, the player
+            being waited on queries the server, or the game times out). Lets the server tell whether anything has
+            changed since a player last checked in
         .logger [TWIML_codenames_API_Server.MongoLogger or LocalLogger] : the object that records the log and either
             stores it in local memory (LocalLogger) or in the mongoDB (MongoLogger)
 
@@ -262,6 +289,7 @@ class Game(object):
         self.game_timed_out = False
         self.game_result = {}
         self.game_start_time = datetime.utcnow()
+        self.version = 0
 
         if logger is None:
             self.logger = LocalLogger()
@@ -295,6 +323,7 @@ class Game(object):
         """
         if self.waiting_query_since > self.waiting_inputs_since: # if the game had been waiting on query
             self.waiting_inputs_since = datetime.utcnow()
+            self.version += 1
         
         return self.curr_team, self.gameboard
 
@@ -307,6 +336,7 @@ class Game(object):
         @param clue_word [str] : the clue word
         @param clue_count [int] : the clue count
         """
+        self.version += 1
         bLegal, explanation = self.legal_clue(clue_word)
         self.logger.add_event({'event': 'clue_given',
                                'timestamp': datetime.utcnow(),
@@ -354,6 +384,7 @@ class Game(object):
 
         if self.waiting_query_since > self.waiting_inputs_since: # if the game had been waiting on query
             self.waiting_inputs_since = datetime.utcnow()
+            self.version += 1
         
         return team_num, clue_word, clue_count, unguessed_words, boardwords, boardmarkers
 
@@ -365,6 +396,7 @@ class Game(object):
 
         @param guesses list[str] : list of the guesses the player wants to make
         """
+        self.version += 1
         if len(guesses) == 0:
             self.logger.add_event({'event': 'end guessing',
                                    'timestamp': datetime.utcnow(),
@@ -608,6 +640,7 @@ class Game(object):
         wait_team, wait_role, wait_player, waiting_for, wait_duration = self.waiting_on_info()
         if wait_duration > max_duration:
             self.game_timed_out = True
+            self.version += 1
             self.game_result = {'timed out waiting on': {'team': wait_team,
                                                          'role': wait_role,
                                                          'player_id': wait_player,
@@ -707,8 +740,7 @@ class Player(object):
             of the player
         .calc_delta_Elo(result, own_team_avg_Elo, opp_team_avg_Elo) : Calculates the change in Elo rating of the player
     """
-    def __init__(self, player_id, Elo = {'Spymaster': 1500., 'Operative': 1500.},
-                 record = {'Spymaster': {'W': 0, 'L': 0}, 'Operative': {'W': 0, 'L': 0}}):
+    def __init__(self, player_id, Elo = None, record = None):
         """
         By default, a new player object is created with Elo 1500 for both roles and W-L record of 0-0 for both roles.
         The option to provide the Elo and record are included so that the server can recreate a player object from info
@@ -721,6 +753,12 @@ class Player(object):
             a player object from disk
         """
         self.player_id = player_id
+        # the defaults are built here rather than in the function signature so that each player gets its own dicts
+        # (default arguments are evaluated only once, so every new player would otherwise share the same ones):
+        if Elo is None:
+            Elo = {'Spymaster': 1500., 'Operative': 1500.}
+        if record is None:
+            record = {'Spymaster': {'W': 0, 'L': 0}, 'Operative': {'W': 0, 'L': 0}}
         self.Elo = Elo
         self.record = record
 
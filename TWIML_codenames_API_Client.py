@@ -6,17 +6,41 @@ Dan Hilgart <dhilgart@gmail.com>
 notes:
     if you change the name of my_model.py, make sure to update it in the imports section
 
-Contains 4 functions:
+Contains 7 functions:
+    decode_ext(code, data) [object] : recreates the numpy arrays and TWIML_codenames.Gameboard objects sent by the server
+    open_http_client() [httpx.AsyncClient] : creates the client used for all requests to the server. Must be called from
+        within the running event loop before any requests are sent
+    send_request(method, url, **kwargs) [httpx.Response] : Sends a request to the server, retrying with exponential
+        backoff if the server cannot be reached or returns a server-side error
     check_status(player_id, player_key) [dict] : Asks the server what the current status is for this contestant. Returns
         the status_dict for the player (as defined in the docstring for this function below)
     query_and_respond(player_id, player_key, game_id, role) : Asks the server for the necessary inputs, calls the
-        appropriate function from my_model.py, and sends the outputs from that function back to the server
+        appropriate function from my_model.py, and sends the outputs from that function back to the server. Both
+        requests go to the server's turn endpoint
     check_if_new_game(active_games, game_id) : Checks whether this is the first time the local user has seen this
         game_id. If so, prints a notification and adds it to active_games
     check_for_ended_games(local_active_games, status_active_games, player_id, player_key) :
 
 Contains the following global variables (set at the bottom of this file):
     root_url [str] : the url of the server
+    ext_code_ndarray [int] : the MessagePack extension type code used by the server for numpy arrays
+    ext_code_gameboard [int] : the MessagePack extension type code used by the server for TWIML_codenames.Gameboard
+        objects
+    decoder [msgspec.msgpack.Decoder] : the MessagePack decoder used for the responses from the server
+    max_concurrent_requests [int] : the maximum number of requests that can be in flight to the server at once
+    max_request_attempts [int] : how many times a request is attempted before giving up
+    retry_wait_initial [float] : how many seconds to wait before the first retry. Doubles with each subsequent retry
+    retry_wait_max [float] : the maximum number of seconds to wait between retries
+    http_client [httpx.AsyncClient] : the client used for all requests to the server. Reuses connections between
+        requests. None until open_http_client() is called
+    request_semaphore [asyncio.Semaphore] : limits the number of requests in flight to max_concurrent_requests. None
+        until open_http_client() is called
+    last_status [dict] : the most recent status received from the server and its ETag, of form
+        {'etag' : <str>, 'status' : status_dict}. Used by check_status to skip re-downloading an unchanged status
+    max_log_attempts [int] : how many checks check_for_ended_games tries to retrieve an ended game's log before giving
+        up on it
+    log_attempts [dict] : the number of failed attempts to retrieve the log for each ended game that is still being
+        retried, of form {game_id : <int>}
 """
 
 """
@@ -33,14 +57,74 @@ Contains the following global variables (set at the bottom of this file):
 """
 import my_model as model # if you change the name of my_model.py, update it here
 import TWIML_codenames # needed because query_and_respond sometimes handles TWIML_codenames.Gameboard objects
-import requests
-import pickle
+import httpx
+import asyncio
+import msgspec
+import numpy as np
 from datetime import datetime, timedelta
 """
 ------------------------------------------------------------------------------------------------------------------------
                                                        Functions
 ------------------------------------------------------------------------------------------------------------------------
 """
+def decode_ext(code, data):
+    """
+    Recreates the numpy arrays and TWIML_codenames.Gameboard objects that the server encodes as MessagePack extension
+        types (see TWIML_codenames_API_Server.encode_hook)
+
+    @param code (int): the extension type code
+    @param data (memoryview): the encoded object
+
+    @returns (np.array or TWIML_codenames.Gameboard): the recreated object
+    """
+    if code == ext_code_ndarray:
+        dtype, values = msgspec.msgpack.decode(data)
+        return np.array(values, dtype=dtype)
+    elif code == ext_code_gameboard:
+        boardwords, boardkey, boardmarkers = msgspec.msgpack.decode(data, ext_hook=decode_ext)
+        return TWIML_codenames.Gameboard.from_arrays(boardwords, boardkey, boardmarkers)
+    else:
+        return msgspec.msgpack.Ext(code, bytes(data))
+
+def open_http_client():
+    """
+    Creates the client used for all requests to the server, along with the semaphore that limits the number of requests
+        in flight. Both are tied to the event loop they are first used in, so this must be called from within the
+        running event loop (see client_run.main)
+
+    @returns http_client (httpx.AsyncClient): the client. Close it when done, e.g. by using it as 'async with
+        open_http_client():'
+    """
+    global http_client, request_semaphore
+    http_client = httpx.AsyncClient()
+    request_semaphore = asyncio.Semaphore(max_concurrent_requests)
+    return http_client
+
+async def send_request(method, url, **kwargs):
+    """
+    Sends a request to the server, retrying with exponential backoff if the server cannot be reached or returns a
+        server-side (5xx) error. At most max_concurrent_requests requests are in flight at once.
+
+    @param method (str): the HTTP method, e.g. 'GET' or 'POST'
+    @param url (str): the url to send the request to
+    @param kwargs: passed through to httpx.AsyncClient.request (e.g. params, json)
+
+    @returns r (httpx.Response): the response from the server. None if the server could not be reached after
+        max_request_attempts attempts
+    """
+    r = None
+    async with request_semaphore:
+        for attempt in range(max_request_attempts):
+            try:
+                r = await http_client.request(method, url, **kwargs)
+                if r.status_code < 500:
+                    return r
+            except httpx.TransportError:
+                r = None
+            if attempt < max_request_attempts - 1:
+                await asyncio.sleep(min(retry_wait_initial * 2 ** attempt, retry_wait_max))
+    return r
+
 async def check_status(player_id, player_key):
     """
     Asks the server what the current status is for this contestant.
@@ -52,19 +136,29 @@ async def check_status(player_id, player_key):
         'ended games' : list[game_ids]}. game_statuses is itself a nested dictionary of form {game_id : game_status}
         with game_status a dictionary of form:
             {'game_id'          : game_id,
-             'game_start_time'  : <datetime>,
+             'game_start_time'  : <datetime, as an ISO 8601 string>,
              'role_info'        : <see role_info as defined in .active_games>,
              'waiting on'       : { 'team'              : <1 or 2>,
                                     'role'              : <'spymaster' or 'operative'>,
                                     'player_id'         : player_id of the player being waited on,
                                     'waiting for'       : <'query' or 'input'>,
-                                    'waiting duration'  : <timedelta>
+                                    'waiting duration'  : <timedelta, as an ISO 8601 string>
                                   }
             }
     """
-    r = requests.get(url=root_url+'/', params={'player_id': player_id, 'player_key': player_key})
-    if r.ok:
-        status_dict = pickle.loads(r.content)
+    # If the status has not changed since the last check, the server replies with an empty 304 (Not Modified) and the
+    # previously received status is reused. Note: the 'waiting duration' values are not updated in that case
+    headers = {}
+    if last_status['etag'] is not None:
+        headers['If-None-Match'] = last_status['etag']
+    r = await send_request('GET', root_url+'/', params={'player_id': player_id, 'player_key': player_key},
+                           headers=headers)
+    if r is not None and r.status_code == 304:
+        return last_status['status']
+    elif r is not None and r.is_success:
+        status_dict = decoder.decode(r.content)
+        last_status['etag'] = r.headers.get('ETag')
+        last_status['status'] = status_dict
         return status_dict
     else:
         return None
@@ -79,11 +173,19 @@ async def query_and_respond(player_id, player_key, game_id, role):
     @param game_id (int): the unique 6-digit identifier for this game
     @param role(str): 'spymaster' or 'operative'
     """
+    # The first call to the turn endpoint (without an answer) returns the inputs for this player's turn:
+    r = await send_request('POST', f'{root_url}/{game_id}/turn/',
+                           params={'player_id': player_id, 'player_key': player_key},
+                           json={})
+    if r is None or not r.is_success:
+        print(f'{datetime.now()}: game {game_id} {role} inputs could not be retrieved from the server')
+        return
+    returned = decoder.decode(r.content)
+    if returned.get('role') != role:
+        # it is no longer this player's turn (the server returned the player's status instead of the inputs)
+        return
+
     if role == 'spymaster':
-        # add error handling below
-        r = requests.get(url=f'{root_url}/{game_id}/generate_clue/',
-                         params={'player_id': player_id, 'player_key': player_key})
-        returned = pickle.loads(r.content)
         team_num = returned['team_num']
         gameboard = returned['gameboard']
         print(f'{datetime.now()}: game {game_id} generate_clue inputs received (team={team_num})')
@@ -92,15 +194,9 @@ async def query_and_respond(player_id, player_key, game_id, role):
         clue_word, clue_count = model.generate_clue(game_id, team_num, gameboard)
         print(f'{datetime.now()}: game {game_id} clue generated. Elapsed time = {datetime.now() - start_time}')
 
-        requests.post(url=f'{root_url}/{game_id}/generate_clue/',
-                      params={'player_id': player_id, 'player_key': player_key},
-                      json={'clue_word':clue_word, 'clue_count':clue_count})
+        answer = {'clue_word':clue_word, 'clue_count':clue_count}
 
     elif role == 'operative':
-        # add error handling below
-        r = requests.get(url=f'{root_url}/{game_id}/generate_guesses/',
-                         params={'player_id': player_id, 'player_key': player_key})
-        returned = pickle.loads(r.content)
         team_num = returned['team_num']
         clue_word = returned['clue_word']
         clue_count = returned['clue_count']
@@ -114,9 +210,12 @@ async def query_and_respond(player_id, player_key, game_id, role):
                                          boardmarkers)
         print(f'{datetime.now()}: game {game_id} guesses generated. Elapsed time = {datetime.now() - start_time}')
 
-        requests.post(url=f'{root_url}/{game_id}/generate_guesses/',
-                      params={'player_id': player_id, 'player_key': player_key},
-                      json={'guesses': guesses})
+        answer = {'guesses': guesses}
+
+    # The second call to the turn endpoint carries the answer:
+    await send_request('POST', f'{root_url}/{game_id}/turn/',
+                       params={'player_id': player_id, 'player_key': player_key},
+                       json=answer)
 
 async def check_if_new_game(active_games, game_id):
     """
@@ -135,8 +234,11 @@ async def check_if_new_game(active_games, game_id):
 
 async def check_for_ended_games(local_active_games, status_active_games, player_id, player_key):
     """
-    Checks whether any games in local_active_games are no longer in status_active_games. If so, pulls the game log for
-        that game so that the reason for ending can be printed. Updates local_active_games as necessary
+    Checks whether any games in local_active_games are no longer in status_active_games. If so, pulls the game logs for
+        those games (in a single request) so that the reason for ending can be printed. Updates local_active_games as
+        necessary. A game whose log could not be retrieved (because the request failed or the log is not in the db yet)
+        is left in local_active_games so that it is tried again on the next check, up to max_log_attempts times. A game
+        for which the server returns an error instead of the log is removed straight away
 
     @param local_active_games [list[int]] : the list of game_ids the local user thinks are active
     @param status_active_games [list[int]] : the list of game_ids that actually are active
@@ -145,29 +247,48 @@ async def check_for_ended_games(local_active_games, status_active_games, player_
 
     @returns local_active_games [list[int]] : the updated local_active_games list
     """
-    for game_id in local_active_games:
-        if game_id not in status_active_games:
+    ended_game_ids = [game_id for game_id in local_active_games if game_id not in status_active_games]
+    if len(ended_game_ids) == 0:
+        return local_active_games
+
+    # pull the logs for all of the ended games in a single request:
+    r = await send_request('GET', f'{root_url}/logs/',
+                           params={'player_id': player_id, 'player_key': player_key, 'game_ids': ended_game_ids})
+    if r is None or not r.is_success:
+        game_logs = {} # count this as a failed attempt for each of the games
+    else:
+        game_logs = decoder.decode(r.content)
+
+    for game_id in ended_game_ids:
+        game_log = game_logs.get(game_id)
+        if isinstance(game_log, dict) and 'ERROR' in game_log:
+            # e.g. the server could not write the game's log to the db, so asking again will not help:
+            print(f'{datetime.now()}: game {game_id} ended: {game_log["ERROR"]}')
+            log_attempts.pop(game_id, None)
             local_active_games.remove(game_id)
-            r = requests.get(url=f'{root_url}/{game_id}/log/',
-                             params={'player_id': player_id, 'player_key': player_key})
-            returned = pickle.loads(r.content)
-            game_log = returned
-            if len(game_log['events']) > 0:
-                if game_log['events'][-1]['event'] == 'game over':
-                    # game completed successfully
-                    end_reason = game_log['events'][-1]['reason']
-                    winning_team_ids = [player['player_id'] for player in game_log['winning team']['players']]
-                    if player_id in winning_team_ids:
-                        print(f'{datetime.now()}: game {game_id} ended: {end_reason}. Result = win!')
-                    else:
-                        print(f'{datetime.now()}: game {game_id} ended: {end_reason}. Result = loss')
+            continue
+        if not isinstance(game_log, dict) or 'events' not in game_log:
+            # the request failed, or the server sent e.g. {'Game log not found' : game_id} because the log is not in the
+            # db yet. Try again on the next check, unless this game has already used up its attempts:
+            log_attempts[game_id] = log_attempts.get(game_id, 0) + 1
+            if log_attempts[game_id] < max_log_attempts:
+                continue
+            print(f'{datetime.now()}: game {game_id} ended: could not retrieve its log after {max_log_attempts} '
+                  f'attempts')
+            del log_attempts[game_id]
+            local_active_games.remove(game_id)
+            continue
+        log_attempts.pop(game_id, None)
+        local_active_games.remove(game_id)
+        if len(game_log['events']) > 0:
+            if game_log['events'][-1]['event'] == 'game over':
+                # game completed successfully
+                end_reason = game_log['events'][-1]['reason']
+                winning_team_ids = [player['player_id'] for player in game_log['winning team']['players']]
+                if player_id in winning_team_ids:
+                    print(f'{datetime.now()}: game {game_id} ended: {end_reason}. Result = win!')
                 else:
-                    # game timed out; did not complete
-                    timedout_player_id = game_log['timed out waiting on']['player_id']
-                    if timedout_player_id == player_id:
-                        print(f'{datetime.now()}: game {game_id} ended: timed out waiting on you!')
-                    else:
-                        print(f'{datetime.now()}: game {game_id} ended: timed out waiting on {timedout_player_id}')
+                    print(f'{datetime.now()}: game {game_id} ended: {end_reason}. Result = loss')
             else:
                 # game timed out; did not complete
                 timedout_player_id = game_log['timed out waiting on']['player_id']
@@ -175,6 +296,13 @@ async def check_for_ended_games(local_active_games, status_active_games, player_
                     print(f'{datetime.now()}: game {game_id} ended: timed out waiting on you!')
                 else:
                     print(f'{datetime.now()}: game {game_id} ended: timed out waiting on {timedout_player_id}')
+        else:
+            # game timed out; did not complete
+            timedout_player_id = game_log['timed out waiting on']['player_id']
+            if timedout_player_id == player_id:
+                print(f'{datetime.now()}: game {game_id} ended: timed out waiting on you!')
+            else:
+                print(f'{datetime.now()}: game {game_id} ended: timed out waiting on {timedout_player_id}')
     return local_active_games
 
 """
@@ -182,4 +310,16 @@ async def check_for_ended_games(local_active_games, status_active_games, player_
                                                     Global Variables
 ------------------------------------------------------------------------------------------------------------------------
 """
-root_url = 'http://twiml-codenames.herokuapp.com'
\ No newline at end of file
+root_url = 'http://twiml-codenames.herokuapp.com'
+ext_code_ndarray = 1 # must match TWIML_codenames_API_Server.ext_code_ndarray
+ext_code_gameboard = 2 # must match TWIML_codenames_API_Server.ext_code_gameboard
+decoder = msgspec.msgpack.Decoder(ext_hook=decode_ext)
+max_concurrent_requests = 16
+max_request_attempts = 5
+retry_wait_initial = 0.1 # seconds
+retry_wait_max = 2 # seconds
+http_client = None # created by open_http_client()
+request_semaphore = None # created by open_http_client()
+last_status = {'etag' : None, 'status' : None}
+max_log_attempts = 10
+log_attempts = {}
\ No newline at end of file
@@ -2,26 +2,54 @@
 TWIML_codenames_API_Server.py: containing functions called by the server for TWIMLfest 2020 codenames competition
 Dan Hilgart <dhilgart@gmail.com>
 
+notes:
+    All database access in this module uses the synchronous pymongo driver. The classes and functions here are only
+        called from the plain 'def' endpoints in server_run.py, which FastAPI runs in its worker threadpool, so the db
+        round-trips do not block the event loop. Calling them from an 'async def' endpoint would stall every other
+        request for the duration of each db round-trip
+
 Contains 4 class definitions:
     Clientlist : Keeps track of which clients are currently actively interacting with the server
     Client : Stores info about an individual client
     Gamelist : Keeps track of which games are currently in progress and stores info for those that have completed
     MongoLogger : Interfaces with MongoDB to write the log for an individual game
 
-Contains 7 functions:
+Contains 20 functions:
+    db_writer() : runs in a background thread, writing the game log updates put on db_write_queue to the db
+    start_db_writer() : starts the db_writer thread if it is not already running
+    write_db_updates(collection, game_updates) : writes one update for each of several games in a single bulk_write,
+        retrying if no server can be selected and recording any failures on the games' MongoLoggers
+    get_wordlist() [np.array[str]] : returns the words from which the gameboards will randomly select 25 words when
+        generated, reading wordlist.txt the first time it is called
+    get_player_key_map() [dict] : returns the player_keys for each player_id, reading player_keys.csv the first time it
+        is called
     validate(player_id, player_key) [bool] : returns True if the player_key is the correct one for the player_id
-    send_as_bytes(var_to_send) [fastapi.Response] : converts any object (including a dict filled with various objects)
-        into bytes to be sent via the API
-    get_leaderboards(db) [dict] : pulls the current leaderboards from the players MongoDB
+    encode_hook(obj) [object] : tells the MessagePack encoder how to encode objects it does not support natively
+    send_as_bytes(var_to_send, headers) [fastapi.Response] : converts any object (including a dict filled with various
+        objects) into MessagePack bytes to be sent via the API
+    send_as_json(var_to_send) [fastapi.Response] : encodes lists, dicts and other JSON-compatible objects as JSON to be
+        sent via the API
+    invalidate_leaderboards() : marks the cached leaderboards as out of date so the next get_leaderboards call rebuilds
+        them
+    add_completed_game(game_id) : adds a game that has just ended to the cached list of completed games
+    get_completed_games(db) [list[int]] : returns the cached list of game_ids for all completed games, pulling it from
+        the db the first time
+    send_as_cached_json(cache_key, version, build, if_none_match) [fastapi.Response] : sends a JSON response, reusing
+        the previously encoded body (or sending a 304) if the data's version has not changed
+    get_leaderboards(db) [dict] : returns the current leaderboards, rebuilding them from the players MongoDB only if a
+        player's Elo has changed since they were last built
+    build_leaderboards(db) [dict] : pulls the current leaderboards from the players MongoDB
     list_player_games(player_to_pull, db) [list[int]] : returns a list of game_ids for all games this player is/was
         involved in
     list_completed_games(db) [list[int]] : returns a list of game_ids for all completed games
     pull_game_log(game_id, player_id, db) [dict] : returns the game log for an individual game
+    pull_game_logs(game_ids, player_id, db) [dict] : returns the game logs for several games, pulled in a single query
     scrub_game_log(game_dict, player_id) [dict] : removes info from the game log that would not be known to the
         player_id who is pulling the log
 
 Contains the following global variables (set at the bottom of this file):
     client_active_timeout [timedelta] : how often a client needs to interact with the server to remain active
+    client_active_timeout_seconds [float] : client_active_timeout in seconds, for comparison against time.monotonic()
     wait_to_start_first_game [timedelta] : how long to wait after a client logs in to the server for the first time
         before requesting template bots to initiate a new game
     wait_to_start_subsequent_games [timedelta] : how long to wait after a client finishes a game before requesting
@@ -33,8 +61,35 @@ Contains the following global variables (set at the bottom of this file):
     min_clients_to_start_new_game [int] : how large the queue of available players needs to be before a new game can be
         started
     max_active_games_per_player [int] : how many games a player can participate in at once
-    wordlist list[str] : the list of words from which the gameboards will randomly select 25 words when generated
-    player_keys [pandas dataframe] : the list of player_ids and associated player_keys for use in player validation
+    ext_code_ndarray [int] : the MessagePack extension type code used for numpy arrays
+    ext_code_gameboard [int] : the MessagePack extension type code used for TWIML_codenames.Gameboard objects
+    encoder [msgspec.msgpack.Encoder] : the MessagePack encoder used by send_as_bytes
+    leaderboard_cache [dict] : the leaderboards as most recently built by get_leaderboards
+    leaderboard_dirty [bool] : True if a player's Elo has changed (or a player has been added) since leaderboard_cache
+        was built
+    leaderboard_lock [threading.Lock] : guards rebuilding leaderboard_cache, since the endpoints run in a threadpool
+    leaderboard_version [int] : incremented every time the leaderboards change
+    completed_games_version [int] : incremented every time a game ends
+    completed_games_cache [list[int]] : the game_ids of all completed games, sorted. None until first requested
+    completed_games_lock [threading.Lock] : guards completed_games_cache, since the endpoints run in a threadpool
+    server_session_id [str] : a random id for this server session, included in ETags so that they are not reused across
+        restarts
+    encoded_response_cache [dict] : the responses cached by send_as_cached_json, of form
+        {cache_key : (version, encoded body)}
+    max_db_write_batch [int] : the maximum number of queued game log updates the db_writer sends in one batch
+    max_db_write_attempts [int] : how many times the db_writer tries a write before giving up when no server can be
+        selected
+    db_write_retry_wait [float] : how many seconds the db_writer waits before its first retry. Doubles with each
+        subsequent retry
+    db_write_wait_timeout [float] : how many seconds MongoLogger.flush(wait=True) waits for its update to be written
+        before treating the game's log as not written
+    list_batch_size [int] : the cursor batch size used for the queries that return lists of game_ids. These documents
+        are tiny, so large batches save round-trips
+    db_write_queue [queue.Queue] : the game log updates waiting to be written by the db_writer thread, as tuples of form
+        (MongoLogger, pymongo.InsertOne or pymongo.UpdateOne (or None), threading.Event to set once written (or None))
+    db_writer_thread [threading.Thread] : the background thread running db_writer. None until started by
+        start_db_writer
+    db_writer_lock [threading.Lock] : guards starting db_writer_thread, since the endpoints run in a threadpool
 """
 
 """
@@ -42,6 +97,7 @@ Contains the following global variables (set at the bottom of this file):
                                                          To Do
 ------------------------------------------------------------------------------------------------------------------------
     - Save/load gamelist to/from disk?
+    - Move the live game state out of process (e.g. into MongoDB) so the server can run with multiple workers
 """
 
 """
@@ -50,12 +106,23 @@ Contains the following global variables (set at the bottom of this file):
 ------------------------------------------------------------------------------------------------------------------------
 """
 import TWIML_codenames
-import pandas as pd
+import csv
+import bisect
 from datetime import datetime, timedelta
 from fastapi import Response # needed for transmitting information in byte format
-import pickle
+import msgspec
+import numpy as np
 import random
-from copy import deepcopy
+import hmac
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+import queue
+from pymongo import InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure, ServerSelectionTimeoutError
+from bson import ObjectId
 """
 ------------------------------------------------------------------------------------------------------------------------
                                                         Classes
@@ -70,14 +137,23 @@ class Clientlist(object):
         .clients [dict] : a dictionary of form {player_id : TWIML_codenames_API_server.Client} for each client who has
             interacted with the server since it was last started.
         .db [pymongo database] : a pointer to the pymongo database connection
+        .active_ids [OrderedDict] : the player_ids (as keys) of the clients that may still be active, ordered from least
+            to most recently active. Template bots are not included. Clients that have timed out are dropped lazily by
+            .drop_inactive_clients()
+        .available_ids [set[int]] : the player_ids of the clients in .active_ids who have fewer than
+            max_active_games_per_player active games
 
     Functions:
         .client_touch(player_id) : Called whenever a client interacts with the server to prevent them timing out
         .add_client(player_id) : Used to add new clients to the clientlist
+        .update_availability(player_id) : Adds or removes the client from .available_ids. Called whenever the client's
+            number of active games changes
+        .drop_inactive_clients() : Removes the clients who have timed out from .active_ids and .available_ids
 
     Properties:
         .active_clients [list[TWIML_codenames_API_server.Client]] : returns a list of all clients that are currently
             active
+        .num_active_clients [int] : the number of clients that are currently active
         .available_clients [list[TWIML_codenames_API_server.Client]] : returns a list of all clients that are currently
             available to start a new game
         .b_games_to_start [bool] : True if there are enough available clients in .available_clients to start a new game
@@ -90,6 +166,8 @@ class Clientlist(object):
         """
         self.clients = {}
         self.db = db
+        self.active_ids = OrderedDict()
+        self.available_ids = set()
 
         # Instantiate the template bots (player_ID = 1, 2, and 3). Note: 3 because a maximum of 3 template bots are
         # needed in any one game
@@ -108,10 +186,18 @@ class Clientlist(object):
 
         @param player_id [int] : the unique 4-digit player identifier
         """
-        if player_id in self.clients.keys():
-            self.clients[player_id].touch()
-        else:
+        client = self.clients.get(player_id) # a single dict lookup, as this is called on every request
+        if client is None:
             self.add_client(player_id)
+        else:
+            client.touch()
+
+        if player_id > 1000: # player_IDs less than 1000 are template bots
+            # move the client to the most recently active end of active_ids. pop and re-insert rather than
+            # move_to_end, which would raise if another request thread dropped the client in between:
+            self.active_ids.pop(player_id, None)
+            self.active_ids[player_id] = None
+            self.update_availability(player_id)
 
     def add_client(self, player_id):
         """
@@ -122,16 +208,53 @@ class Clientlist(object):
         """
         self.clients[player_id] = Client(player_id, self.db)
 
+    def update_availability(self, player_id):
+        """
+        Adds the client to .available_ids if it is active and has fewer than max_active_games_per_player active games,
+            otherwise removes it. Called whenever the client is touched or its number of active games changes
+
+        @param player_id [int] : the unique 4-digit player identifier
+        """
+        if player_id in self.active_ids and self.clients[player_id].num_active_games < max_active_games_per_player:
+            self.available_ids.add(player_id)
+        else:
+            self.available_ids.discard(player_id)
+
+    def drop_inactive_clients(self):
+        """
+        Removes the clients who have timed out from .active_ids and .available_ids. Since .active_ids is ordered from
+            least to most recently active, only the timed out clients at the front of it need to be checked
+        """
+        now = time.monotonic() # read the clock once for all of the clients checked
+        while True:
+            # another request thread may be touching or dropping clients at the same time, so don't assume that
+            # active_ids still holds the same player_id between reading and removing it:
+            try:
+                player_id = next(iter(self.active_ids), None)
+            except RuntimeError: # active_ids changed size between creating the iterator and reading from it
+                continue
+            if player_id is None or self.clients[player_id].is_active(now):
+                break
+            self.active_ids.pop(player_id, None)
+            self.available_ids.discard(player_id)
+
     @property
     def active_clients(self):
         """
         @returns [list[TWIML_codenames_API_server.Client]] : a list of all the clients that are currently active (those
             who have interacted with the server in any way within the client_active_timeout duration)
         """
-        active_clients = [client for client in self.clients.values() if client.active
-                          and client.player_id > 1000 # player_IDs less than 1000 are template bots
-                          ]
-        return active_clients
+        self.drop_inactive_clients()
+        # iterate a snapshot, as other request threads may add or drop clients while this is running:
+        return [self.clients[player_id] for player_id in list(self.active_ids)]
+
+    @property
+    def num_active_clients(self):
+        """
+        @returns [int] : the number of clients that are currently active
+        """
+        self.drop_inactive_clients()
+        return len(self.active_ids)
 
     @property
     def available_clients(self):
@@ -139,9 +262,9 @@ class Clientlist(object):
         @returns [list[TWIML_codenames_API_server.Client]] : a list of currently active clients who aren't involved in a
             game already
         """
-        available_clients = [client for client in self.active_clients
-                             if client.num_active_games < max_active_games_per_player]
-        return available_clients
+        self.drop_inactive_clients()
+        # iterate a snapshot, as other request threads may add or drop clients while this is running:
+        return [self.clients[player_id] for player_id in list(self.available_ids)]
 
     @property
     def b_games_to_start(self):
@@ -150,13 +273,15 @@ class Clientlist(object):
 
         @returns [bool] : True if a new game can be started
         """
-        if len(self.available_clients) >= min_clients_to_start_new_game:
+        self.drop_inactive_clients()
+        if len(self.available_ids) >= min_clients_to_start_new_game:
             return True
         else:
             start_game_early = False
-            for client in self.available_clients:
-                if datetime.utcnow() >= client.waiting_for_game_since + wait_to_start \
-                        and client.num_active_games == 0:
+            now = datetime.utcnow()
+            for player_id in list(self.available_ids): # a snapshot, as other request threads may change available_ids
+                client = self.clients[player_id]
+                if now >= client.waiting_for_game_since + wait_to_start and client.num_active_games == 0:
                     start_game_early = True
                     break
             return start_game_early
@@ -172,6 +297,8 @@ class Client(object):
         .waiting_for_game_since [datetime] : the timestamp of the most recent time the client has started waiting for a
             game
         .prev_active [datetime] : the timestamp of the 2nd-most recent time the client interacted with the server
+        .active_until [float] : the time.monotonic() time at which the client will become inactive if it does not interact
+            with the server again
         .active_games [dict] : a nested dictionary of form {game_id : role_info} for each active game this player is
             involved in. role_info is itself a dictionary of form:
                 {'team'         : <1 or 2>,
@@ -188,17 +315,26 @@ class Client(object):
 
     Functions:
         .touch() : Called whenever a client interacts with the server to prevent them from timing out
-        .return_status(gamelist) [dict] : returns the current status of the player including the status for each active
+        .is_active(now) [bool] : True if the client has interacted with the server more recently than the
+            client_active_timeout. now is the current time.monotonic() time, if the caller has already read it
+        .return_status(gamelist, b_check_ended_games) [dict] : returns the current status of the player including the status for each active
             game and a list of the game_id for each ended_game
+        .status_etag(gamelist) [str] : returns a tag that changes whenever the player's status changes
         .new_game(game_id, game) : after a new game is created by the Gamelist object, it calls this function which adds
             the game info to the client's active_games dict
-        .move_ended_game(game_id, b_completed, game_result) : after a game ends, this function is called by the Gamelist
-            object. This populates the client's ended_games dict and removes it from the client's active_games dict
+        .move_ended_game(game_id, b_completed, game_result) [pymongo.UpdateOne] : after a game ends, this function is
+            called by the Gamelist object. This populates the client's ended_games dict and removes it from the client's
+            active_games dict. Returns the update to be written to the client's MongoDB entry
 
     Properties:
         .active [bool] : True if the client has interacted with the server more recently than the client_active_timeout
         .num_active_games [int] : the number of games the client is currently participating in
     """
+    # one Client is kept for every player seen since the server started, so __slots__ is used to avoid a per-instance
+    # __dict__:
+    __slots__ = ('player_id', 'player', 'last_active', 'waiting_for_game_since', 'prev_active', 'active_until',
+                 'active_games', 'ended_games', 'db', 'db_id')
+
     def __init__(self, player_id, db):
         """
         Instantiate a new Client
@@ -210,44 +346,45 @@ class Client(object):
         self.last_active = datetime.utcnow()
         self.waiting_for_game_since = datetime.utcnow()
         self.prev_active = 0
+        self.active_until = time.monotonic() + client_active_timeout_seconds
         self.active_games = {}
         self.ended_games = {}
         self.db = db
 
-        # Read player data from MongoDB
-        result = db.players.find_one(filter={"player_id": player_id})
+        # Read player data from MongoDB. Only the fields needed to recreate the Player are pulled, and the lookup is backed
+        # by the unique player_id index:
+        result = db.players.find_one(filter={"player_id": player_id}, projection={'_id': 1, 'Elo': 1, 'record': 1})
 
         if result is None: # if playerdata does not exist in MongoDB:
-            # all new clients were being created with pointers to the same TWIML_codenames.Player object for some
-            # reason. This deepcopy seems to have fixed it:
-            self.player = deepcopy(TWIML_codenames.Player(player_id))
+            self.player = TWIML_codenames.Player(player_id)
             player_doc = {'player_id':player_id,
                           'Elo': self.player.Elo,
                           'record': self.player.record
                           }
             self.db_id = db.players.insert_one(player_doc).inserted_id
+            invalidate_leaderboards()
         else:
             self.db_id = result['_id']
-            # all new clients were being created with pointers to the same TWIML_codenames.Player object for some
-            # reason. This deepcopy seems to have fixed it:
-            self.player = deepcopy(TWIML_codenames.Player(player_id = player_id,
-                                                          Elo = result['Elo'],
-                                                          record = result['record'])
-                                   )
+            self.player = TWIML_codenames.Player(player_id = player_id,
+                                                 Elo = result['Elo'],
+                                                 record = result['record'])
 
     def touch(self):
         """
         Updates the .last_active and .prev_active timestamps
         """
+        now = time.monotonic()
+        utcnow = datetime.utcnow()
         # Check if this is the client's first touch after being inactive:
-        if not self.active:
+        if not self.is_active(now):
             # if this client had been inactive, reset the waiting_for_game counter
-            self.waiting_for_game_since = datetime.utcnow()
+            self.waiting_for_game_since = utcnow
 
         self.prev_active = self.last_active
-        self.last_active = datetime.utcnow()
+        self.last_active = utcnow
+        self.active_until = now + client_active_timeout_seconds
         
-    def return_status(self, gamelist):
+    def return_status(self, gamelist, b_check_ended_games=True):
         """
         Returns the current status of the player including the status for each active game and a list of the game_id for
             each ended_game. This is called by the @app.get(root) API call and is also called whenever a player calls an
@@ -257,6 +394,8 @@ class Client(object):
         @param gamelist [TWIML_codenames_API_Server.Gamelist] : a pointer to the gamelist. Required so the
             gamelist.check_for_ended_games(game_ids_to_check) function can be called and also so the
             TWIML_codenames.Game objects can be accessed
+        @param b_check_ended_games [bool](optional) : if False, the caller has already called
+            gamelist.check_for_ended_games for this client's active games, so it is not called again
 
         @returns [dict] : a nested dictionary of form {'active games' : game_statuses, 'ended games' : list[game_ids]}
             game_statuses is itself a nested dictionary of form {game_id : game_status} with game_status a dictionary of
@@ -273,7 +412,8 @@ class Client(object):
                 }
         """
         # The check for game timeouts are only called when players in that game check in:
-        gamelist.check_for_ended_games(self.active_games.keys())
+        if b_check_ended_games:
+            gamelist.check_for_ended_games(self.active_games)
         
         game_statuses = {}
         for game_id, role_info in self.active_games.items():
@@ -288,7 +428,25 @@ class Client(object):
                                                       'waiting duration' : wait_duration
                                                       } 
                                       }
-        return {'active games' : game_statuses, 'ended games' : [x for x in self.ended_games.keys()]}
+        return {'active games' : game_statuses, 'ended games' : list(self.ended_games)}
+
+    def status_etag(self, gamelist):
+        """
+        Returns a tag identifying the current status of the player, for use as an HTTP ETag. The tag changes whenever
+            the status returned by .return_status() changes, apart from the 'waiting duration' values which change
+            continuously. Lets clients that poll the server skip downloading a status they have already seen
+        The caller must call gamelist.check_for_ended_games for this client's active games first, so that the tag
+            reflects any games that have just ended
+
+        @param gamelist [TWIML_codenames_API_Server.Gamelist] : a pointer to the gamelist. Required so the
+            TWIML_codenames.Game objects can be accessed
+
+        @returns [str] : the (quoted) ETag for the player's current status
+        """
+        game_versions = ','.join([f'{game_id}.{gamelist[game_id].version}' for game_id in self.active_games])
+        # ended games are only ever added to self.ended_games, so the count identifies the list. The game versions and
+        # the count start over when the server restarts, so the server_session_id keeps the tags from being reused:
+        return f'"{server_session_id}-{self.player_id}-{game_versions}-{len(self.ended_games)}"'
         
     def new_game(self, game_id, game):
         """
@@ -302,22 +460,11 @@ class Client(object):
         @param game_id [int] : the unique 6-digit game identifier
         @param game [TWIML_codenames.Game] : the game that was just created
         """
-        if game.teams[0][0].player_id == self.player_id:
-            team = 1
-            role = 'spymaster'
-            teammate_id = game.teams[0][1].player_id
-        if game.teams[0][1].player_id == self.player_id:
-            team = 1
-            role = 'operative'
-            teammate_id = game.teams[0][0].player_id
-        if game.teams[1][0].player_id == self.player_id:
-            team = 2
-            role = 'spymaster'
-            teammate_id = game.teams[1][1].player_id
-        if game.teams[1][1].player_id == self.player_id:
-            team = 2
-            role = 'operative'
-            teammate_id = game.teams[1][0].player_id
+        # game.teams is [[team 1 spymaster, team 1 operative], [team 2 spymaster, team 2 operative]]:
+        roles = ['spymaster', 'operative']
+        role_lookup = {team[i].player_id : (team_num, roles[i], team[1-i].player_id)
+                       for team_num, team in enumerate(game.teams, start=1) for i in range(2)}
+        team, role, teammate_id = role_lookup[self.player_id]
         self.active_games[game_id] = {'team' : team, 'role' : role, 'teammate_id' : teammate_id}
 
     def move_ended_game(self, game_id, b_completed, game_result):
@@ -335,14 +482,19 @@ class Client(object):
         @param game_id [int] : the unique 6-digit game identifier
         @param b_completed [bool] : True if the game played out until there was a winner, False if it timed out
         @param game_result [dict] : TWIML_Codenames.Game.game_result dictionary
+
+        @returns db_update [pymongo.UpdateOne] : the update to this player's MongoDB entry for the new Elo and W/L
+            ratings. None if the game did not complete (or had already been moved). The Gamelist writes the updates for
+            all of the players in the game in a single bulk_write
         """
+        db_update = None
         # Sometimes this function is called a second time after the game has already been moved. So first check if this
         # game still exists in self.active_games:
-        if game_id in self.active_games.keys():
+        if game_id in self.active_games:
             # if the game completed, the Elo and W/L ratings will have changed, so update the MongoDB entry for this player:
             if b_completed:
-                self.db.players.update_one(filter={"_id": self.db_id}, update={"$set": {'Elo': self.player.Elo}})
-                self.db.players.update_one(filter={"_id": self.db_id}, update={"$set": {'record': self.player.record}})
+                db_update = UpdateOne(filter={"_id": self.db_id},
+                                      update={"$set": {'Elo': self.player.Elo, 'record': self.player.record}})
             self.ended_games[game_id] = {'game_id' : game_id,
                                          'role_info': self.active_games[game_id],
                                          'completed': b_completed,
@@ -350,13 +502,25 @@ class Client(object):
                                          }
             del self.active_games[game_id]
             self.waiting_for_game_since = datetime.utcnow() + wait_after_game
+        return db_update
+
+    def is_active(self, now=None):
+        """
+        @param now [float](optional) : the current time.monotonic() time, if the caller has already read it
+
+        @returns [bool] : True if the client has interacted with the server more recently than the client_active_timeout
+        """
+        if now is None:
+            now = time.monotonic()
+        # compare against the expiry time set by .touch() rather than doing datetime arithmetic on every check:
+        return now < self.active_until
 
     @property
     def active(self):
         """
         @returns [bool] : True if the client has interacted with the server more recently than the client_active_timeout
         """
-        return (datetime.utcnow()-self.last_active < client_active_timeout)
+        return self.is_active()
 
     @property
     def num_active_games(self):
@@ -381,9 +545,9 @@ class Gamelist(object):
             {game_id : {'completed' : <True if the game played out until there was a winner, False if it timed out>,
                         'result' : <TWIML_Codenames.Game.game_result dictionary>}
             }
-        .next_game_id [int] : the unique 6-digit integer to be used as the game_id the next time a game is created
 
     Functions:
+        .reserve_game_ids(num_ids) [range] : reserves the next num_ids unique 6-digit game_ids from the counter in the db
         .new_game(available_clients) : creates a new game(s) and updates the client objects as necessary
         .check_for_ended_games(game_ids_to_check) : checks a list of games to see if any of them have ended
         .move_ended_game(game_id, b_completed) : moves an ended game from the active_games dict to the ended_games dict
@@ -400,10 +564,27 @@ class Gamelist(object):
         self.db = clientlist.db
         self.active_games = {}
         self.ended_games = {}
-        self.next_game_id = \
-            max([x['game_id'] for x in self.db.games.find(projection=['game_id'])] # Get list of all game_ids in the db
-                +[100000] # If there aren't any game_ids yet, start at 100000
-                )+1 # The next game needs to be one higher than the max
+        # game_ids are handed out by the 'game_id' document in the counters collection. Make sure the counter is at least
+        # as high as the highest game_id already in the db (this is a single lookup on the game_id index):
+        last_game = self.db.games.find_one(projection=['game_id'], sort=[('game_id', -1)])
+        self.db.counters.update_one(filter={"_id": 'game_id'},
+                                    update={"$max": {'seq': 100000 if last_game is None else last_game['game_id']}},
+                                    upsert=True) # If there aren't any game_ids yet, start at 100000
+
+    def reserve_game_ids(self, num_ids):
+        """
+        Reserves the next num_ids unique 6-digit game_ids. The counter is incremented atomically in the db so no game_id
+            is ever handed out twice, even across server restarts
+
+        @param num_ids [int] : the number of game_ids to reserve
+
+        @returns [range] : the reserved game_ids
+        """
+        counter = self.db.counters.find_one_and_update(filter={"_id": 'game_id'},
+                                                       update={"$inc": {'seq': num_ids}},
+                                                       upsert=True,
+                                                       return_document=ReturnDocument.AFTER)
+        return range(counter['seq'] - num_ids + 1, counter['seq'] + 1)
 
     def __getitem__(self, key):
         """
@@ -417,9 +598,11 @@ class Gamelist(object):
                 {'completed' : <True if the game played out until there was a winner, False if it timed out>,
                  'result' : <TWIML_Codenames.Game.game_result dictionary>}
         """
-        if key in self.active_games.keys():
-            return self.active_games[key]['Game object']
-        elif key in self.ended_games.keys():
+        # one dict lookup for an active game (the common case), rather than a membership test followed by an index:
+        active_game = self.active_games.get(key)
+        if active_game is not None:
+            return active_game['Game object']
+        elif key in self.ended_games:
             return self.ended_games[key]
         # need to add error checking if game isn't in either dict
 
@@ -433,45 +616,56 @@ class Gamelist(object):
         """
         # If this game is starting early (if a player on the server has been waiting too long for a game to start),
         # there may be fewer than 4 clients in the available_clients list. In this case, append template bots until the
-        # available_clients list has at least 4 clients
-        for i in range(4 - len(available_clients)):
-            available_clients.append(
-                self.clientlist[i+1] # a pointer to a template bot's Client object
-            )
-
-        num_new_games = len(available_clients) // 4
-        random.shuffle(available_clients)
+        # available_clients list has at least 4 clients. The bots are added to a new list so the caller's list is left
+        # unchanged
+        template_bots = [self.clientlist[i+1] # a pointer to a template bot's Client object
+                         for i in range(4 - len(available_clients))]
+        candidates = available_clients + template_bots
+
+        num_new_games = len(candidates) // 4
+        # random.sample only draws the clients that will be placed in a game, rather than shuffling the whole list:
+        selected_clients = random.sample(candidates, 4*num_new_games)
+        new_game_ids = self.reserve_game_ids(num_new_games)
         for i in range(num_new_games):
-            game_clients = available_clients[4*i:4*(i+1)]
+            game_clients = selected_clients[4*i:4*(i+1)]
             team1 = [client.player for client in game_clients[:2]]
             team2 = [client.player for client in game_clients[2:]]
-            new_game_id = self.next_game_id
-            self.next_game_id += 1
-            gameboard = TWIML_codenames.Gameboard(wordlist)
+            new_game_id = new_game_ids[i]
+            gameboard = TWIML_codenames.Gameboard(get_wordlist())
             logger=MongoLogger(new_game_id, self.db)
             self.active_games[new_game_id] = {'Game object' : TWIML_codenames.Game(gameboard, team1, team2, logger),
                                               'clients' : [client.player_id for client in game_clients]
                                               }
+            logger.flush() # write the starting info for the game to the db
             for client in game_clients:
                 client.new_game(new_game_id, self.active_games[new_game_id]['Game object'])
+                self.clientlist.update_availability(client.player_id)
 
     def check_for_ended_games(self, game_ids_to_check):
         """
         Checks a list of games to see if any of them have ended. Checks for both completed games and timed out games.
         If a game has ended, call .move_ended_game(game_id, b_completed) to move it from the active_games dict to the
             ended_games dict in the Gamelist as well as in each Client
+        Otherwise, writes any log entries for the game that are waiting in its logger to the db
         This function is called every time the .return_status() function is called for a client object. The
             game_ids_to_check are the active games for that client.
 
         @param game_ids_to_check list[int] : a list of the game_ids to be checked (those ids of the active games of the
-            client who called this function)
+            client who called this function). Any iterable of game_ids (e.g. the client's active_games dict) works
         """
-        game_ids_to_check = [game_id for game_id in game_ids_to_check if game_id in self.active_games.keys()]
-        for game_id in game_ids_to_check:
-            if self.active_games[game_id]['Game object'].game_completed:
+        active_games = self.active_games
+        # game_ids_to_check may be a client's active_games dict, which move_ended_game modifies, so copy it first:
+        for game_id in list(game_ids_to_check):
+            active_game = active_games.get(game_id)
+            if active_game is None:
+                continue
+            game = active_game['Game object']
+            if game.game_completed:
                 self.move_ended_game(game_id, b_completed=True)
-            elif self.active_games[game_id]['Game object'].check_timed_out(client_active_timeout):
+            elif game.check_timed_out(client_active_timeout):
                 self.move_ended_game(game_id, b_completed=False)
+            else:
+                game.logger.flush()
 
     def move_ended_game(self, game_id, b_completed):
         """
@@ -485,12 +679,24 @@ class Gamelist(object):
         @param game_id [int] : the unique 6-digit game identifier
         @param b_completed [bool] : True if the game played out until there was a winner, False if it timed out
         """
+        # make sure the full game log is in the db before the game is marked as ended. If the log could not be written,
+        # the game still ends but is not listed as a completed game:
+        if self.active_games[game_id]['Game object'].logger.flush(wait=True):
+            add_completed_game(game_id)
         game_result = self.active_games[game_id]['Game object'].game_result
         self.ended_games[game_id] = {'completed': b_completed,
                                      'result': game_result
                                      }
+        db_updates = []
         for client in self.active_games[game_id]['clients']:
-            self.clientlist[client].move_ended_game(game_id, b_completed, game_result)
+            db_update = self.clientlist[client].move_ended_game(game_id, b_completed, game_result)
+            if db_update is not None:
+                db_updates.append(db_update)
+            self.clientlist.update_availability(client)
+        # write the new Elo and W/L ratings for all of the game's players in one round-trip:
+        if len(db_updates) > 0:
+            self.db.players.bulk_write(db_updates, ordered=False)
+            invalidate_leaderboards()
         del self.active_games[game_id]
         if self.clientlist.b_games_to_start:
             self.new_game(self.clientlist.available_clients)
@@ -501,22 +707,40 @@ class Gamelist(object):
 
         @returns [bool] : True if the game is active, False if it has ended
         """
-        return (game_id in self.active_games.keys())
+        return (game_id in self.active_games)
 
 class MongoLogger(object):
     """
     Interfaces with MongoDB to write the log for an individual game
+    To save round-trips to the db, fields and events are held in memory until .flush() is called, which combines them
+        into a single update. The Gamelist calls .flush() after every turn and before a game is moved to ended_games
+    The game's document is not created until the first .flush(), so the starting info recorded by .record_config() is
+        part of the inserted document rather than a separate update
+    The update itself is not sent from the request's thread: it is put on db_write_queue and sent by the background
+        db_writer thread, which batches the updates for all games into one bulk_write. Call .flush(wait=True) when the
+        update needs to be in the db before continuing
+    If one of the game's updates cannot be written, the error is kept in .write_error and none of the game's later
+        updates are sent (they would be applied to a log that is missing part of the game). .flush() then returns False
 
     Instance variables:
         .game_id [int] : the unique 6-digit identifier for this game
         .db [pymongo database] : a pointer to the pymongo database connection
-        .db_id [pymongo ObjectID] : the unique ObjectID for this game's document in the database
+        .db_id [pymongo ObjectID] : the unique ObjectID for this game's document in the database. Generated locally so
+            that it is known before the document is inserted
+        .b_inserted [bool] : True once the insert of this game's document has been sent to be written to the db
+        .write_error [Exception] : the error from the first of this game's updates that could not be written to the db
+            (or a TimeoutError if .flush(wait=True) gave up waiting for one). None if all of them have been written (or
+            are still waiting to be)
+        .pending_fields [dict] : the fields set since the last flush, of form {field_name : val}
+        .pending_events [list[dict]] : the events added since the last flush
 
     Functions:
         .record_config(gameboard, teams) : called when a TWIML_codenames.game object is initialized. Populates starting
             info about the game to the game_log
         .set_field(field_name, val) : sets a field in the top level of the game_log
         .add_event(event_dict) : adds the event to the end of the list of events
+        .flush(wait) [bool] : sends the pending fields and events to be written to the db. Returns False if the game's
+            log could not be written
     """
     def __init__(self, game_id, db):
         """
@@ -527,13 +751,11 @@ class MongoLogger(object):
         """
         self.game_id = game_id
         self.db = db
-
-        # Create new document in db:
-        game_doc = {'game_id':game_id,
-                    'in_progress':True,
-                    'events':[]
-                    }
-        self.db_id = db.games.insert_one(game_doc).inserted_id
+        self.db_id = ObjectId()
+        self.b_inserted = False
+        self.write_error = None
+        self.pending_fields = {}
+        self.pending_events = []
 
     def record_config(self, gameboard, teams):
         """
@@ -543,8 +765,9 @@ class MongoLogger(object):
         @param teams [list[list[TWIML_codenames.Player]] : the list of Player objects for each of the players in each
             team
         """
-        self.set_field('boardwords', [[str(x) for x in row] for row in gameboard.boardwords])
-        self.set_field('boardkey', [[int(x) for x in row] for row in gameboard.boardkey])
+        # .tolist() converts the whole array to nested lists of python str/int (which MongoDB can store) in one call:
+        self.set_field('boardwords', gameboard.boardwords.astype(str).tolist())
+        self.set_field('boardkey', gameboard.boardkey.astype(int).tolist())
         self.set_field('teams', {'team 1':[player.player_id for player in teams[0]],
                                  'team 2':[player.player_id for player in teams[1]]})
 
@@ -555,7 +778,7 @@ class MongoLogger(object):
         @param field_name [str] : the key name of the field to be set
         @param val [any] : the value to be set
         """
-        self.db.games.update_one(filter={"_id": self.db_id}, update={"$set": {field_name: val}})
+        self.pending_fields[field_name] = val
 
     def add_event(self, event_dict):
         """
@@ -563,12 +786,196 @@ class MongoLogger(object):
 
         @param event_dict [dict] : the dictionary capturing the info associated with the event
         """
-        self.db.games.update_one(filter={"_id": self.db_id}, update={"$push": {"events": event_dict}})
+        self.pending_events.append(event_dict)
+
+    def flush(self, wait=False):
+        """
+        Combines the pending fields and events into a single update and puts it on db_write_queue to be written to the db
+            by the db_writer thread. On the first call, the update is the insert of the game's document
+
+        @param wait [bool](optional) : if True, does not return until the update (and so every earlier update for this
+            game) has been written to the db, or until db_write_wait_timeout has passed, in which case the game's log is
+            treated as not written
+
+        @returns [bool] : False if any of this game's updates could not be written to the db (see .write_error). If wait
+            is False, only the updates written so far are known, so this can still return True for an update that later
+            fails
+        """
+        if self.write_error is not None:
+            # the game's log is already incomplete in the db, so there is no point sending more updates to it:
+            return False
+
+        # swap in new containers first so anything logged while the update is in flight is kept for the next flush:
+        fields, self.pending_fields = self.pending_fields, {}
+        events, self.pending_events = self.pending_events, []
+
+        if not self.b_inserted:
+            # the first flush creates the game's document, including everything logged so far:
+            game_doc = {'_id':self.db_id,
+                        'game_id':self.game_id,
+                        'in_progress':True,
+                        **fields,
+                        'events':events
+                        }
+            db_update = InsertOne(game_doc)
+            self.b_inserted = True
+        else:
+            update = {}
+            if len(fields) > 0:
+                update["$set"] = fields
+            if len(events) > 0:
+                update["$push"] = {"events": {"$each": events}}
+            db_update = UpdateOne(filter={"_id": self.db_id}, update=update) if len(update) > 0 else None
+        start_db_writer()
+        if wait:
+            # even with nothing new to write, queue a marker so this waits for any earlier updates still in the queue:
+            written = threading.Event()
+            db_write_queue.put((self, db_update, written))
+            if not written.wait(timeout=db_write_wait_timeout) and self.write_error is None:
+                # don't hold the request's thread any longer. Whether the update is written later is unknown, so the
+                # game's log is treated as incomplete:
+                self.write_error = TimeoutError(f'timed out after {db_write_wait_timeout} seconds waiting for the log '
+                                                f'for game {self.game_id} to be written to the db')
+        elif db_update is not None:
+            db_write_queue.put((self, db_update, None))
+        return self.write_error is None
 """
 ------------------------------------------------------------------------------------------------------------------------
                                                        Functions
 ------------------------------------------------------------------------------------------------------------------------
 """
+def db_writer():
+    """
+    Runs in a background thread for the life of the server, writing the game log updates put on db_write_queue by
+        MongoLogger.flush. Waits for an update, then takes everything else already on the queue (up to
+        max_db_write_batch updates) and writes them with as few bulk_writes as possible
+    Each game's updates are written in the order they were queued: the first update for every game in the batch is
+        written in one bulk_write, then the second update for every game that has one, and so on. Since no two updates
+        in the same bulk_write are for the same game, a failed update only affects the game it belongs to
+    """
+    while True:
+        batch = [db_write_queue.get()]
+        while len(batch) < max_db_write_batch:
+            try:
+                batch.append(db_write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        updates_by_game = {}
+        update_num = 0
+        try:
+            # group the updates by game, keeping each game's updates in the order they were queued:
+            for logger, db_update, _ in batch:
+                game_updates = updates_by_game.setdefault(logger, [])
+                if db_update is not None:
+                    game_updates.append(db_update)
+
+            while True:
+                # the update_num-th update for each game that still has one (and whose log has not already failed),
+                # grouped by collection:
+                to_write = {}
+                for logger, game_updates in updates_by_game.items():
+                    if update_num < len(game_updates) and logger.write_error is None:
+                        collection = logger.db.games
+                        to_write.setdefault(collection.full_name, (collection, []))[1].append(
+                            (logger, game_updates[update_num]))
+                if len(to_write) == 0:
+                    break
+                for collection, game_updates in to_write.values():
+                    write_db_updates(collection, game_updates)
+                update_num += 1
+        except Exception as e:
+            # this thread must keep running, or every later .flush(wait=True) would have to time out. Any game in the
+            # batch with updates that may not have been written is treated as failed:
+            for logger, _, _ in batch:
+                game_updates = updates_by_game.get(logger)
+                if logger.write_error is None and (game_updates is None or update_num < len(game_updates)):
+                    logger.write_error = e
+            print(f'{datetime.utcnow()}: error writing a batch of game logs to the db: {e!r}')
+        finally:
+            # the waiters check their game's .write_error once woken up:
+            for _, _, written in batch:
+                if written is not None:
+                    written.set()
+
+def start_db_writer():
+    """
+    Starts the db_writer thread if it is not already running. Called by MongoLogger.flush before each update is queued,
+        so the thread is only started once there is something to write (rather than whenever this module is imported)
+    """
+    global db_writer_thread
+    if db_writer_thread is not None and db_writer_thread.is_alive():
+        return
+    with db_writer_lock: # the endpoints run in a threadpool, so two flushes could otherwise both start a thread
+        if db_writer_thread is None or not db_writer_thread.is_alive():
+            db_writer_thread = threading.Thread(target=db_writer, daemon=True)
+            db_writer_thread.start()
+
+def write_db_updates(collection, game_updates):
+    """
+    Writes one update for each of several games in a single unordered bulk_write. Any update that cannot be written
+        has its error recorded in its MongoLogger's .write_error
+    The bulk_write is only sent again by this function if no server could be selected, since then none of it was sent.
+        A connection lost partway through is left to pymongo's retryable writes: resending the whole bulk_write would
+        push the events of the games that had already been written a second time (and fail their inserts as duplicates)
+
+    @param collection [pymongo collection] : the collection the updates are written to
+    @param game_updates [list[tuple]] : tuples of form (MongoLogger, pymongo.InsertOne or pymongo.UpdateOne), with no
+        two tuples for the same game
+    """
+    for attempt in range(max_db_write_attempts):
+        try:
+            collection.bulk_write([db_update for _, db_update in game_updates], ordered=False)
+            return
+        except BulkWriteError as e:
+            # the bulk_write is unordered, so every update without an error was written:
+            for write_error in e.details['writeErrors']:
+                logger = game_updates[write_error['index']][0]
+                logger.write_error = OperationFailure(write_error['errmsg'], write_error['code'])
+                print(f'{datetime.utcnow()}: error writing the log for game {logger.game_id} to the db: '
+                      f'{logger.write_error}')
+            return
+        except ServerSelectionTimeoutError as e:
+            # nothing was sent, so wait for the db to become reachable and then try the whole bulk_write again:
+            if attempt < max_db_write_attempts - 1:
+                print(f'{datetime.utcnow()}: could not reach the db to write game logs, retrying: {e}')
+                time.sleep(db_write_retry_wait * 2 ** attempt)
+                continue
+            error = e
+        except Exception as e:
+            # includes errors raised before anything is sent, e.g. a bson.errors.InvalidDocument for a value in an event
+            # that cannot be encoded:
+            error = e
+        for logger, _ in game_updates:
+            logger.write_error = error
+        print(f'{datetime.utcnow()}: error writing the logs for games {[logger.game_id for logger, _ in game_updates]} '
+              f'to the db: {error}')
+        return
+
+@lru_cache(maxsize=None)
+def get_wordlist():
+    """
+    Loads the list of words from which the gameboards will randomly select 25 words when generated. The file is only
+        read the first time this is called; after that, the same array is returned
+
+    @returns wordlist [np.array[str]] : the words from wordlist.txt. Stored as an np.array so the gameboards can index
+        into it directly (see TWIML_codenames.Gameboard.generate_board)
+    """
+    with open('wordlist.txt', 'r') as wordlist_file:
+        return np.array([line.strip() for line in wordlist_file])
+
+@lru_cache(maxsize=None)
+def get_player_key_map():
+    """
+    Loads the player_ids and associated player_keys for use in player validation. The file is only read the first time
+        this is called; after that, the same dict is returned
+
+    @returns player_key_map [dict] : the contents of player_keys.csv as a dict of form {player_id : player_key} so
+        validation is a single lookup
+    """
+    with open('player_keys.csv', 'r', newline='') as player_keys_file:
+        return {int(row['player_id']): int(row['player_key']) for row in csv.DictReader(player_keys_file)}
+
 def validate(player_id, player_key):
     """
     @param player_id [int] : the unique 4-digit player identifier
@@ -576,24 +983,126 @@ def validate(player_id, player_key):
 
     @returns [bool] : True if the player_key is the correct one for the player_id
     """
-    # Check if there is a row in player_keys that has both the player_id and the player_key. If the first dimension of
-    # the resulting shape is 1, then there is and the player_key is validated:
-    return player_keys.loc[(player_keys['player_id']==player_id) &
-                           (player_keys['player_key']==player_key)].shape[0] == 1
+    # Look up the correct key for the player_id. compare_digest takes the same time whether or not the keys match, so
+    # the response time does not give away how much of a guessed key was correct:
+    correct_key = get_player_key_map().get(player_id)
+    return correct_key is not None and hmac.compare_digest(str(correct_key), str(player_key))
 
-def send_as_bytes(var_to_send):
+def encode_hook(obj):
     """
-    converts any object (including a dict filled with various objects) into bytes to be sent via the API
+    Tells the MessagePack encoder how to encode objects it does not support natively. numpy arrays and
+        TWIML_codenames.Gameboard objects are encoded as MessagePack extension types so that the client can recreate
+        them (see TWIML_codenames_API_Client.decode_ext). numpy scalars are converted to the equivalent python type
+
+    @param obj [object] : the object to be encoded
+
+    @returns [object] : an object the MessagePack encoder does support
+    """
+    if isinstance(obj, TWIML_codenames.Gameboard):
+        return msgspec.msgpack.Ext(ext_code_gameboard,
+                                   msgspec.msgpack.encode([obj.boardwords, obj.boardkey, obj.boardmarkers],
+                                                          enc_hook=encode_hook))
+    elif isinstance(obj, np.ndarray):
+        return msgspec.msgpack.Ext(ext_code_ndarray, msgspec.msgpack.encode([obj.dtype.str, obj.tolist()]))
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    else:
+        raise NotImplementedError(f'Objects of type {type(obj)} cannot be sent via the API')
+
+def send_as_bytes(var_to_send, headers=None):
+    """
+    converts any object (including a dict filled with various objects) into MessagePack bytes to be sent via the API
+    datetimes and timedeltas are sent as ISO 8601 strings
+    This is CPU-bound; it is only called from the plain 'def' endpoints in server_run.py, which FastAPI runs in its
+        worker threadpool rather than on the event loop
 
     @param var_to_send [object] : the object to be encoded as bytes
+    @param headers [dict](optional) : any additional headers to send with the response
 
     @returns [fastapi.Response] : the object encoded as bytes
     """
-    return Response(content=pickle.dumps(var_to_send))
+    return Response(content=encoder.encode(var_to_send), media_type='application/msgpack', headers=headers)
+
+def send_as_json(var_to_send):
+    """
+    Encodes lists, dicts and other JSON-compatible objects as JSON to be sent via the API. Used by the endpoints that
+        return JSON so that FastAPI's jsonable_encoder (which walks the whole object in python) is skipped
+
+    @param var_to_send [object] : the object to be encoded as JSON
+
+    @returns [fastapi.Response] : the object encoded as JSON
+    """
+    return Response(content=msgspec.json.encode(var_to_send), media_type='application/json')
+
+def invalidate_leaderboards():
+    """
+    Marks the cached leaderboards as out of date so the next get_leaderboards call rebuilds them. Called whenever a
+        player's Elo is written to (or a new player is added to) the players MongoDB
+    """
+    global leaderboard_dirty, leaderboard_version
+    leaderboard_dirty = True
+    leaderboard_version += 1
+
+def add_completed_game(game_id):
+    """
+    Adds a game that has just ended to completed_games_cache (if it has been loaded yet) and marks any encoded copies of
+        the list as out of date. Called whenever a game ends, after its log has been written to the db
+
+    @param game_id [int] : the unique 6-digit identifier for the game that ended
+    """
+    global completed_games_version
+    with completed_games_lock:
+        if completed_games_cache is not None:
+            # keep the list sorted (as it is when pulled from the db) and skip the game if the initial pull included it:
+            i = bisect.bisect_left(completed_games_cache, game_id)
+            if i == len(completed_games_cache) or completed_games_cache[i] != game_id:
+                completed_games_cache.insert(i, game_id)
+        completed_games_version += 1
+
+def get_completed_games(db):
+    """
+    Returns a list of game_ids for all completed games. The list is only pulled from the db the first time; after that,
+        games are added to it by add_completed_game as they end
+
+    @param db [pymongo db] : a connection to the pymongo db
+
+    @returns completed_game_ids [list[int]] : a list of the unique 6-digit identifiers for each completed game
+    """
+    global completed_games_cache
+    with completed_games_lock:
+        if completed_games_cache is None:
+            completed_games_cache = list_completed_games(db)
+        return list(completed_games_cache)
+
+def send_as_cached_json(cache_key, version, build, if_none_match=None):
+    """
+    Sends a JSON response for data that rarely changes (e.g. the leaderboards). The encoded body is kept in
+        encoded_response_cache until the version changes, so repeat polls neither rebuild nor re-encode the data. The
+        response carries an ETag for the version; if the request's If-None-Match matches it, an empty 304 (Not Modified)
+        is sent instead
+
+    @param cache_key [str] : the name under which the response is cached
+    @param version [int] : the current version of the data. Must be read before the data itself is built
+    @param build [function] : called with no arguments to build the data if the cached version is out of date
+    @param if_none_match [str](optional) : the If-None-Match header from the request
+
+    @returns [fastapi.Response] : the data encoded as JSON, or an empty 304 response
+    """
+    etag = f'"{server_session_id}-{cache_key}-{version}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+
+    cached = encoded_response_cache.get(cache_key)
+    if cached is None or cached[0] != version:
+        cached = (version, msgspec.json.encode(build()))
+        encoded_response_cache[cache_key] = cached
+    return Response(content=cached[1], media_type='application/json', headers=headers)
 
 def get_leaderboards(db):
     """
-    Pulls the current leaderboards from the players MongoDB
+    Returns the current leaderboards. These only change when a player's Elo changes, so they are cached in
+        leaderboard_cache and only pulled from the players MongoDB again once invalidate_leaderboards has been called
 
     @param db [pymongo db] : a connection to the pymongo db
 
@@ -602,24 +1111,45 @@ def get_leaderboards(db):
          'Operatives' : list[(player_id,Elo)],
          'Combined'   : list[(player_id,Elo)]}
     """
-    results = db.players.find()
-    leaderboards = {'Spymasters': [],
-                    'Operatives': [],
-                    'Combined': []
+    global leaderboard_cache, leaderboard_dirty
+    with leaderboard_lock:
+        if leaderboard_dirty or leaderboard_cache is None:
+            # clear the flag before reading so that an Elo update which lands during the rebuild triggers another one:
+            leaderboard_dirty = False
+            leaderboard_cache = build_leaderboards(db)
+        # copy the lists so the caller cannot modify the cached leaderboards:
+        return {key: list(leaderboard) for key, leaderboard in leaderboard_cache.items()}
+
+def build_leaderboards(db):
+    """
+    Pulls the current leaderboards from the players MongoDB
+
+    @param db [pymongo db] : a connection to the pymongo db
+
+    @returns leaderboards [dict] : see get_leaderboards
+    """
+    # Sort in the db rather than in python. The Spymaster and Operative sorts come first in their pipelines so that
+    # they are backed by the Elo indexes created in config.get_connection:
+    spymasters = db.players.aggregate([{'$sort': {'Elo.Spymaster': -1, 'player_id': 1}},
+                                       {'$project': {'_id': 0, 'player_id': 1, 'Elo': 1, 'record.Spymaster': 1}}])
+    operatives = db.players.aggregate([{'$sort': {'Elo.Operative': -1, 'player_id': 1}},
+                                       {'$project': {'_id': 0, 'player_id': 1, 'Elo': 1, 'record.Operative': 1}}])
+    combined = db.players.aggregate([{'$project': {'_id': 0,
+                                                   'player_id': 1,
+                                                   'Combined': {'$divide': [{'$add': ['$Elo.Spymaster',
+                                                                                      '$Elo.Operative']}, 2]}}},
+                                     {'$sort': {'Combined': -1, 'player_id': 1}}])
+
+    leaderboards = {'Spymasters': [(player['player_id'],
+                                    player['Elo']['Spymaster'],
+                                    f'{player["record"]["Spymaster"]["W"]}-{player["record"]["Spymaster"]["L"]}')
+                                   for player in spymasters],
+                    'Operatives': [(player['player_id'],
+                                    player['Elo']['Operative'],
+                                    f'{player["record"]["Operative"]["W"]}-{player["record"]["Operative"]["L"]}')
+                                   for player in operatives],
+                    'Combined': [(player['player_id'], player['Combined']) for player in combined]
                     }
-    for player in results:
-        player_id = player['player_id']
-        Elo = player['Elo']
-        leaderboards['Spymasters'].append((player_id,
-                                           Elo['Spymaster'],
-                                           f'{player["record"]["Spymaster"]["W"]}-{player["record"]["Spymaster"]["L"]}'))
-        leaderboards['Operatives'].append((player_id,
-                                           Elo['Operative'],
-                                           f'{player["record"]["Operative"]["W"]}-{player["record"]["Operative"]["L"]}'))
-        leaderboards['Combined'].append((player_id, (Elo['Spymaster'] + Elo['Operative'])/2))
-
-    for key, leaderboard in leaderboards.items():
-        leaderboards[key] = sorted(leaderboard, key=lambda k: k[1], reverse=True)
 
     return leaderboards
 
@@ -632,13 +1162,13 @@ def list_player_games(player_to_pull, db):
 
     @returns game_ids [list[int]] : a list of the unique 6-digit ids for each game this player is/was involved in
     """
-    results = db.games.find(projection=['game_id', 'teams'])
-    game_ids=[]
-    for game_dict in results:
-        game_players = [player for team in game_dict['teams'].values() for player in team]
-        if player_to_pull in game_players:
-            game_ids.append(game_dict['game_id'])
-    return game_ids
+    # let the db find the player's games (using the indexes on each team's list of player_ids created in
+    # config.get_connection) rather than pulling every game and checking its teams here:
+    results = db.games.find(filter={"$or": [{'teams.team 1': player_to_pull}, {'teams.team 2': player_to_pull}]},
+                            projection={'_id': 0, 'game_id': 1},
+                            sort=[('game_id', 1)]) # $or results are not in any particular order
+    results = results.batch_size(list_batch_size)
+    return [game_dict['game_id'] for game_dict in results]
 
 def list_completed_games(db):
     """
@@ -648,11 +1178,11 @@ def list_completed_games(db):
 
     @returns completed_game_ids [list[int]] : a list of the unique 6-digit identifiers for each completed game in the db
     """
-    results = db.games.find(filter={"in_progress": False}, projection=['game_id'])
-    completed_game_ids=[]
-    for game_dict in results:
-        completed_game_ids.append(game_dict['game_id'])
-    return completed_game_ids
+    # covered by the (in_progress, game_id) index created in config.get_connection, so no documents need to be read.
+    # The hint stops the sort on game_id from tempting the planner into walking the game_id index instead:
+    results = db.games.find(filter={"in_progress": False}, projection={'_id': 0, 'game_id': 1}, sort=[('game_id', 1)])
+    results = results.hint([('in_progress', 1), ('game_id', 1)]).batch_size(list_batch_size)
+    return [game_dict['game_id'] for game_dict in results]
 
 def pull_game_log(game_id, player_id, db):
     """
@@ -664,11 +1194,31 @@ def pull_game_log(game_id, player_id, db):
 
     @returns game_dict [dict] : the scrubbed game_dict
     """
-    game_dict=db.games.find_one(filter={"game_id": game_id})
-    if game_dict is None:
-        return {'Game log not found':game_id}
-    else:
-        return scrub_game_log(game_dict, player_id)
+    return pull_game_logs([game_id], player_id, db)[game_id]
+
+def pull_game_logs(game_ids, player_id, db):
+    """
+    Returns the game logs for several games, pulled from the db in a single query
+
+    @param game_ids [list[int]] : the unique 6-digit identifiers for the games
+    @param player_id [int] : the player_id of the player pulling the logs
+    @param db [pymongo db] : a connection to the pymongo db
+
+    @returns game_dicts [dict] : a dict of form {game_id : the scrubbed game_dict}. For any game_id that is not in the
+        db, the game_dict is replaced by {'Game log not found' : game_id}
+    """
+    # While the game is in progress, the boardkey is only sent by the db if the player is one of the spymasters (see
+    # scrub_game_log), so it is dropped in the same round-trip instead of being pulled and then discarded:
+    spymasters = [{'$arrayElemAt': ['$teams.team 1', 0]}, {'$arrayElemAt': ['$teams.team 2', 0]}]
+    hide_boardkey = {'$and': ['$in_progress', {'$not': [{'$in': [player_id, spymasters]}]}]}
+    results = db.games.aggregate([{'$match': {'game_id': {'$in': list(game_ids)}}},
+                                  {'$project': {'_id': 0}},
+                                  {'$addFields': {'boardkey': {'$cond': [hide_boardkey, '$$REMOVE', '$boardkey']}}}])
+
+    game_dicts = {game_id: {'Game log not found': game_id} for game_id in game_ids}
+    for game_dict in results:
+        game_dicts[game_dict['game_id']] = scrub_game_log(game_dict, player_id)
+    return game_dicts
 
 def scrub_game_log(game_dict, player_id):
     """
@@ -680,31 +1230,43 @@ def scrub_game_log(game_dict, player_id):
     @returns temp_dict [dict] : the scrubbed game_dict
     """
 
-    temp_dict = deepcopy(game_dict)
-    del temp_dict['_id']
-    spymasters = [temp_dict['teams']['team 1'][0], temp_dict['teams']['team 2'][0]]
-    operatives = [temp_dict['teams']['team 1'][1], temp_dict['teams']['team 2'][1]]
+    # Only the parts of the log that get scrubbed are copied; everything else is shared with game_dict:
+    temp_dict = dict(game_dict)
+    temp_dict.pop('_id', None)
+    team1 = temp_dict['teams']['team 1']
+    team2 = temp_dict['teams']['team 2']
+    spymasters = (team1[0], team2[0])
+    operatives = (team1[1], team2[1])
+    # the team number on which the player is the spymaster/operative (None if the player does not have that role):
+    spymaster_team_num = spymasters.index(player_id) + 1 if player_id in spymasters else None
+    operative_team_num = operatives.index(player_id) + 1 if player_id in operatives else None
 
     # While game is in progress, only let the spymasters see the boardkey
-    if temp_dict['in_progress'] and player_id not in spymasters:
-        del temp_dict['boardkey'] # boardkey is only known by spymasters
+    if temp_dict['in_progress'] and spymaster_team_num is None:
+        temp_dict.pop('boardkey', None) # boardkey is only known by spymasters
 
     #remove details about illegal clues and illegal guesses except for the players who gave them
+    # (this is deliberately done here rather than with $map/$cond in pull_game_logs' aggregation pipeline: it decides
+    # what players are allowed to see, so it is kept where it is easy to read and check. Only the few scrubbed events
+    # are copied, so the loop is cheap)
+    scrubbed_events = []
     for event in temp_dict['events']:
+        event_type = event['event'] # an event can only be one type, so at most one of the branches below applies
         # remove info about illegal clues, except for the giver of the illegal clue
-        if event['event'] == 'clue_given': # only interested in clue_given events
+        if event_type == 'clue_given': # only interested in clue_given events
             if event['legal_clue'] != 'Yes': # only interested in illegal clues
                 # only scrub the illegal clue if the player_id doesn't match the spymaster for this event
-                if player_id != spymasters[event['team_num']-1]:
-                    del event['clue_word']
-                    del event['clue_count']
+                if event['team_num'] != spymaster_team_num:
+                    event = {key: val for key, val in event.items() if key not in ('clue_word', 'clue_count')}
                     event['legal_clue'] = 'Illegal clue given' # overwrite the explanation of why the clue was illegal
 
         # remove info about illegal guesses, except for the giver of the illegal guess
-        if event['event'] == 'guess skipped: guess not in unguessed_words':
+        elif event_type == 'guess skipped: guess not in unguessed_words':
             # only scrub the illegal guess if the player_id doesn't match the operative for this event
-            if player_id != operatives[event['team_num'] - 1]:
-                del event['word_guessed']
+            if event['team_num'] != operative_team_num:
+                event = {key: val for key, val in event.items() if key != 'word_guessed'}
+        scrubbed_events.append(event)
+    temp_dict['events'] = scrubbed_events
 
     return temp_dict
 """
@@ -713,12 +1275,30 @@ def scrub_game_log(game_dict, player_id):
 ------------------------------------------------------------------------------------------------------------------------
 """
 client_active_timeout = timedelta(minutes = 5)
+client_active_timeout_seconds = client_active_timeout.total_seconds()
 wait_to_start_first_game = timedelta(seconds=10)
 wait_to_start_subsequent_games = timedelta(minutes=10)
 wait_to_start = wait_to_start_first_game
 wait_after_game = wait_to_start_subsequent_games - wait_to_start_first_game
 min_clients_to_start_new_game = 6 # needs to be >4 or a new game will start with the same players each time a game ends
 max_active_games_per_player = 1
-# load the list of words from which the gameboards will randomly select 25 words when generated:
-wordlist = [line.strip() for line in open('wordlist.txt', 'r').readlines()]
-player_keys = pd.read_csv('player_keys.csv')
\ No newline at end of file
+ext_code_ndarray = 1
+ext_code_gameboard = 2
+encoder = msgspec.msgpack.Encoder(enc_hook=encode_hook)
+leaderboard_cache = None
+leaderboard_dirty = True
+leaderboard_lock = threading.Lock()
+leaderboard_version = 0
+completed_games_version = 0
+completed_games_cache = None
+completed_games_lock = threading.Lock()
+server_session_id = uuid.uuid4().hex[:8]
+encoded_response_cache = {}
+max_db_write_batch = 1000
+max_db_write_attempts = 5
+db_write_retry_wait = 0.5 # seconds
+db_write_wait_timeout = 60 # seconds
+list_batch_size = 1000
+db_write_queue = queue.Queue()
+db_writer_thread = None
+db_writer_lock = threading.Lock()
\ No newline at end of file
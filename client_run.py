@@ -2,26 +2,56 @@
 client_run.py: run this file (using "python client_run.py") to participate in the TWIMLfest 2020 codenames competition
 Dan Hilgart <dhilgart@gmail.com>
 
-This file starts an async event loop and then adds a new task each X seconds to ping the server and get the current
-    status for the player. If the server is waiting for this player, it will call
+This file starts an async event loop which pings the server each X seconds to get the current status for the player.
+    If the server is waiting for this player, it will call
     TWIML_codenames_API_Client.query_and_respond() which in turn:
         asks the server for the necessary inputs
         calls the appropriate function from my_model.py
         sends the outputs from that function back to the server
 """
 
-import TWIML_codenames_API_Client
 import asyncio
-import time
+try:
+    # uvloop is an optional, faster drop-in replacement for the asyncio event loop (not available on Windows). Once
+    # installed, asyncio.run uses it:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+import TWIML_codenames_API_Client
 import json
+from datetime import datetime
+
+async def main(active_games):
+    """
+    Opens the connection to the server and then runs check_status_loop until the program is stopped. The connection is
+        opened here, inside the running event loop, so that it is tied to that loop
+    """
+    async with TWIML_codenames_API_Client.open_http_client():
+        await check_status_loop(active_games)
 
 async def check_status_loop(active_games):
     """
-    The main loop that creates a new task every X seconds to find out whether anything is expected from the player
+    The main loop that checks every X seconds to find out whether anything is expected from the player
+    Each status check is awaited before the next one starts, so checks never pile up if the server is slow to respond
+        and only one check at a time modifies active_games
+    While the player is in a game, the server is checked every poll_interval_min seconds. While the player is waiting
+        for a game (or the server cannot be reached, or the check fails), the wait between checks doubles each time up
+        to poll_interval_max seconds
     """
+    poll_interval = poll_interval_min
     while True:
-        loop.create_task(check_status(active_games))
-        await asyncio.sleep(1)
+        try:
+            status = await check_status(active_games)
+        except Exception as e:
+            # a failed check (e.g. a response that cannot be decoded) must not stop the client; try again later:
+            print(f'{datetime.now()}: status check failed: {e!r}')
+            status = None
+        if status is not None and len(status['active games']) > 0:
+            poll_interval = poll_interval_min
+        else:
+            poll_interval = min(poll_interval * 2, poll_interval_max)
+        await asyncio.sleep(poll_interval)
 
 async def check_status(active_games):
     """
@@ -30,19 +60,21 @@ async def check_status(active_games):
             asks the server for the necessary inputs
             calls the appropriate function from my_model.py
             sends the outputs from that function back to the server
+
+    @returns status (dict): the status received from the server (see TWIML_codenames_API_Client.check_status). None if
+        the server could not be reached or returned an error
     """
     # request the status from the server:
-    status = None
-    while status is None:
-        status = await TWIML_codenames_API_Client.check_status(player_id, player_key)
-        if status is None:
-            time.sleep(1) # do not execute any other calls to the server while waiting to retry check_status
+    status = await TWIML_codenames_API_Client.check_status(player_id, player_key)
 
-    if 'ERROR' in status.keys():
+    if status is None:
+        return None
+    elif 'ERROR' in status:
         print(status)
+        return None
     else:
         # Have any active games ended?
-        active_games = await TWIML_codenames_API_Client.check_for_ended_games(active_games, status['active games'].keys(),
+        active_games = await TWIML_codenames_API_Client.check_for_ended_games(active_games, status['active games'],
                                                                               player_id, player_key)
 
         # Does the player have any active games?
@@ -52,14 +84,20 @@ async def check_status(active_games):
                 # is this a new game?
                 active_games = await TWIML_codenames_API_Client.check_if_new_game(active_games, game_data['game_id'])
 
-                # ...check if the server is waiting on this player:
-                if game_data['waiting on']['player_id'] == player_id:
-                    # if so, call query_and_respond()
-                    loop.create_task(TWIML_codenames_API_Client.query_and_respond(player_id=player_id,
-                                                                                  player_key=player_key,
-                                                                                  game_id=game_data['game_id'],
-                                                                                  role=game_data['waiting on']['role']
-                                                                                  ))
+                # ...check if the server is waiting on this player (and the player is not already taking its turn):
+                game_id = game_data['game_id']
+                if game_data['waiting on']['player_id'] == player_id and game_id not in games_in_turn:
+                    # if so, call query_and_respond(). It runs as its own task so that a slow model does not hold up
+                    # the status checks:
+                    games_in_turn.add(game_id)
+                    role = game_data['waiting on']['role']
+                    task = asyncio.create_task(TWIML_codenames_API_Client.query_and_respond(player_id=player_id,
+                                                                                         player_key=player_key,
+                                                                                         game_id=game_id,
+                                                                                         role=role
+                                                                                         ))
+                    task.add_done_callback(lambda task, game_id=game_id: games_in_turn.discard(game_id))
+        return status
 
 if __name__ == "__main__":
     # Load player_id and player_key from the myPlayerID-Key.txt file
@@ -68,15 +106,13 @@ if __name__ == "__main__":
     player_key = int(PlayerID_Key['Player_Key'])
 
     active_games = []
+    games_in_turn = set() # the game_ids for which a query_and_respond task is currently running
+    poll_interval_min = 1 # seconds between status checks while the player is in a game
+    poll_interval_max = 30 # seconds; must stay well below the server's client_active_timeout (5 minutes) so the player
+                           # is still counted as active while waiting for a game
 
-    # Create the async event loop
-    loop = asyncio.get_event_loop()
-    task = loop.create_task(check_status_loop(active_games))
-
-    # run the loop
+    # Create the async event loop and run it (asyncio.run closes the loop when done)
     try:
-        loop.run_until_complete(task)
+        asyncio.run(main(active_games))
     except asyncio.CancelledError:
         pass
-    finally:
-        loop.close()
@@ -1,22 +1,35 @@
 from pydantic import BaseSettings
+from functools import lru_cache
 import pymongo 
 
 class Settings(BaseSettings):
     db_connection: str 
     db_collection:str = 'codenames'
+    debug: bool = False # set DEBUG=1 to print the settings (including the connection string) on startup
 
     class Config:
         env_file = ".env"
 
+# the settings, MongoClient (and its connection pool) and indexes are only set up on the first call; later calls return
+# the same db:
+@lru_cache(maxsize=1)
 def get_connection():
     settings = Settings()
 
-
-    print (settings)
+    if settings.debug:
+        print (settings)
     db_client = pymongo.MongoClient(settings.db_connection)
     db = db_client[settings.db_collection]
 
     db.players.create_index([('player_id', pymongo.ASCENDING)], unique=True)
+    # backs the sorts used to build the leaderboards:
+    db.players.create_index([('Elo.Spymaster', pymongo.DESCENDING), ('player_id', pymongo.ASCENDING)])
+    db.players.create_index([('Elo.Operative', pymongo.DESCENDING), ('player_id', pymongo.ASCENDING)])
     db.games.create_index([('game_id', pymongo.ASCENDING)], unique=True)
+    # covers the list of completed games (filter on in_progress, return only game_id) so it is answered from the index:
+    db.games.create_index([('in_progress', pymongo.ASCENDING), ('game_id', pymongo.ASCENDING)])
+    # back the lookup of the games a player is/was involved in:
+    db.games.create_index([('teams.team 1', pymongo.ASCENDING)])
+    db.games.create_index([('teams.team 2', pymongo.ASCENDING)])
 
     return db
@@ -20,7 +20,6 @@ Add/modify as necessary
 """
 ### YOUR CODE HERE
 import spacy # after installing, be sure to run 'python -m spacy download en_core_web_lg'
-import itertools
 import pickle
 ### END YOUR CODE
 
@@ -33,8 +32,10 @@ For example, if you are loading word vectors, load them here as global variables
     time the generate_clue and generate_guesses functions are called  
 """
 ### YOUR CODE HERE
-nlp = spacy.load("en_core_web_lg") # if OSError: [E050] Can't find model 'en_core_web_lg', run this from command line:
-                                   # 'python -m spacy download en_core_web_lg'
+# only the word vectors (nlp.vocab) are used, so the tagger, parser and named entity recognizer are not loaded.
+# if OSError: [E050] Can't find model 'en_core_web_lg', run this from command line:
+# 'python -m spacy download en_core_web_lg'
+nlp = spacy.load("en_core_web_lg", disable=['tagger', 'parser', 'ner'])
 
 # clue_word_distances is a dict containing a 2D numpy array of word distances that have already been pre-calculated in
 # order to speed up compute time. The dict also contains 2 additional dicts, both of form {word:index}, for the words on
@@ -53,12 +54,6 @@ clue_word_distances = pickle.load(open('clue_word_distances.pkl','rb'))
 Add/modify functions as necessary
 """
 ### YOUR CODE HERE
-def dist(word1, word2):
-    """
-    Calculates the vector-distance between two words
-    """
-    tokens = nlp(word1 + " " + word2)
-    return 1 - tokens[0].similarity(tokens[1])
 ### END YOUR CODE
 
 """
@@ -110,66 +105,49 @@ def generate_clue(game_id, team_num, gameboard: TWIML_codenames.Gameboard):
     unguessed_good_words = gameboard.unguessed_words(team_num)
     unguessed_bad_words = [word for word in gameboard.unguessed_words() if word not in unguessed_good_words]
 
-    # filter out words that contain, or are contained in, words on the board:
-    full_candidates=[]
-    for candidate in clue_word_distances['clue_words'].keys(): # see definition of clue_word_distances in the 'Your Global Variables' section above.
-        duplicate = False
-        for unguessed_word in gameboard.unguessed_words():
-            if candidate in unguessed_word:
-                duplicate = True
-                break
-            elif unguessed_word in candidate:
-                duplicate = True
-                break
-        if duplicate == False:
-            full_candidates.append(candidate)
+    # filter out words that contain, or are contained in, words on the board (see definition of clue_word_distances in
+    # the 'Your Global Variables' section above). The unguessed words are pulled from the gameboard once, rather than
+    # once per candidate:
+    unguessed_words = gameboard.unguessed_words()
+    full_candidates = [candidate for candidate in clue_word_distances['clue_words']
+                       if not any(candidate in unguessed_word or unguessed_word in candidate
+                                  for unguessed_word in unguessed_words)]
 
     # sample down the list of candidates by a factor of 3 for two reasons: 1) to improve runtime and 2) to avoid getting
     # stuck giving the same clue word over and over again
     candidates = [word for word in
                   np.random.choice(full_candidates, len(full_candidates)//3, replace=False)]
 
-    good_word_distances = {}
-    for good_word in unguessed_good_words:
-        good_word_distances[good_word] = {}
-        for clue_candidate in candidates:
-            good_word_distances[good_word][clue_candidate] = clue_word_distances['distances'][
-                clue_word_distances['boardwords'][good_word], # the index number of the good_word on the boardwords index
-                clue_word_distances['clue_words'][clue_candidate] # the index number of the clue_candidate on the clue_words index
-            ]
-
-    bad_word_distances = {}
-    for bad_word in unguessed_bad_words:
-        bad_word_distances[bad_word] = {}
-        for clue_candidate in candidates:
-            bad_word_distances[bad_word][clue_candidate] = clue_word_distances['distances'][
-                clue_word_distances['boardwords'][bad_word], # the index number of the bad_word on the boardwords index
-                clue_word_distances['clue_words'][clue_candidate] # the index number of the clue_candidate on the clue_words index
-            ]
+    # pull the distances between each board word and each candidate out of the pre-calculated array in one indexing
+    # operation per set of words. Rows are the words (in the order of unguessed_good_words/unguessed_bad_words) and
+    # columns are the candidates (in the order of candidates):
+    candidate_indices = [clue_word_distances['clue_words'][clue_candidate] for clue_candidate in candidates]
+    good_word_indices = [clue_word_distances['boardwords'][good_word] for good_word in unguessed_good_words]
+    bad_word_indices = [clue_word_distances['boardwords'][bad_word] for bad_word in unguessed_bad_words]
+    good_word_distances = clue_word_distances['distances'][np.ix_(good_word_indices, candidate_indices)]
+    bad_word_distances = clue_word_distances['distances'][np.ix_(bad_word_indices, candidate_indices)]
+    # the distance from each candidate to its closest bad word (only depends on the candidate, so calculated once):
+    min_bad_word_distances = bad_word_distances.min(axis=0, initial=float('Inf'))
+
+    # For a given candidate and clue_count, the best combination of good words to aim for is always the clue_count good
+    # words closest to the candidate: that combination has both the lowest score and the lowest d_r_max of any
+    # combination of that size. So rather than trying every combination, sort each candidate's good word distances and
+    # take the closest 1, 2, 3... of them. Row k-1 of each array below is for a clue_count of k:
+    sorted_good_word_distances = np.sort(good_word_distances, axis=0)
+    clue_counts = np.arange(1, len(unguessed_good_words)+1).reshape(-1, 1)
+    d_r_scores = np.cumsum(sorted_good_word_distances, axis=0) / clue_counts / clue_counts
+    d_r_maxes = sorted_good_word_distances # the furthest of the k closest good words is the k-th closest
+    valid = (d_r_maxes < min_bad_word_distances - margin) & (d_r_maxes < threshold)
+    d_r_scores = np.where(valid, d_r_scores, float('Inf'))
 
     clue_count = 0
     clue_word = None
-    low_score = float('Inf')
-
-    for clue_count_to_try in range(1,len(unguessed_good_words)+1):
-        for good_word_combo in itertools.combinations(unguessed_good_words,clue_count_to_try):
-            for clue_candidate in candidates:
-                w_d = float('Inf')
-                for bad_word in unguessed_bad_words:
-                    if bad_word_distances[bad_word][clue_candidate] < w_d:
-                        w_d = bad_word_distances[bad_word][clue_candidate]
-                d_r_sum = 0
-                d_r_max = 0
-                for good_word in good_word_combo:
-                    this_distance = good_word_distances[good_word][clue_candidate]
-                    d_r_sum += this_distance
-                    if this_distance > d_r_max:
-                        d_r_max = this_distance
-                d_r_score = d_r_sum / len(good_word_combo) / len(good_word_combo)
-                if d_r_score <= low_score and d_r_max < w_d - margin and d_r_max < threshold:
-                    low_score = d_r_score
-                    clue_word = clue_candidate
-                    clue_count = clue_count_to_try
+    if d_r_scores.size > 0 and np.isfinite(d_r_scores.min()):
+        # on a tie, prefer the highest clue_count (and then the last candidate):
+        best = np.flatnonzero(d_r_scores.ravel() == d_r_scores.min())[-1]
+        clue_count_num, candidate_num = np.unravel_index(best, d_r_scores.shape)
+        clue_word = candidates[candidate_num]
+        clue_count = int(clue_count_num) + 1
 
     if not clue_word:
         # if it didn't find a good clue word, return a random word
@@ -212,20 +190,20 @@ def generate_guesses(game_id, team_num, clue_word, clue_count, unguessed_words,
     # by A. Kim, M. Ruzmaykin, A. Truong, and A. Summerville 2019
     threshold_for_guessing = 0.7
 
+    # the (cosine) distance between the clue word and each unguessed word, all calculated at once from the word vectors.
+    # A word without a vector is treated as unrelated (distance 1):
+    clue_vector = nlp.vocab[clue_word].vector
+    word_vectors = np.array([nlp.vocab[word].vector for word in unguessed_words])
+    norms = np.linalg.norm(word_vectors, axis=1) * np.linalg.norm(clue_vector)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = 1 - np.where(norms > 0, word_vectors @ clue_vector / norms, 0)
+
+    # guess the closest words first, stopping at clue_count guesses or once the words are too far from the clue:
     guesses = []
-    while len(guesses) < clue_count:
-        best = None
-        d = float('Inf')
-        for word in unguessed_words:
-            distance = dist(clue_word, word)
-            if (distance < d):
-                d = distance
-                best = word
-        if (best and d < threshold_for_guessing):
-            guesses.append(best)
-            unguessed_words.remove(best)
-        else:
+    for word_num in np.argsort(distances, kind='stable')[:clue_count]:
+        if distances[word_num] >= threshold_for_guessing:
             break
+        guesses.append(unguessed_words[word_num])
     if len(guesses) == 0:
         guesses.append(str(np.random.choice(unguessed_words,1)[0]))
     ### END YOUR CODE
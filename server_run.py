@@ -5,30 +5,43 @@ Dan Hilgart <dhilgart@gmail.com>
 notes:
     This file is written to be run on uvicorn using the FastAPI library by calling 'uvicorn server_run:app' from the
         command line
-    This server has 10 functions by which clients can interact with it:
+    This server has 12 functions by which clients can interact with it:
         get(root) : returns the current status for the player
+        post(turn) : returns the inputs the player will need for their turn, or, if the body contains the player's
+            answer (clue_word and clue_count, or guesses), updates the game accordingly
         get(generate_clue) : returns the inputs the player will need to generate a clue
         post(generate_clue) : receives the clue_word and clue_count from the player and updates the game accordingly
         get(generate_guesses) : returns the inputs the player will need to generate a list of guesses
         post(generate_guesses) : receives the list of guesses from the player and updates the game accordingly
         get(log) : returns the game log for an individual game
+        get(logs) : returns the game logs for several games at once
         get(games_by_player) : returns a list of game_ids for all games this player is/was involved in
         get(completed_games) : returns a list of game_ids for all completed games
         get(num_active_clients) : returns a count of how many active clients are logged in to the server
         get(leaderboards) : returns the current leaderboards
     Most of the supporting functions and classes are defined in TWIML_codenames_API_Server
+    The server must run as a single process (one uvicorn worker): the clientlist and gamelist objects hold the live
+        game state in memory, so each additional worker would hold its own, inconsistent copy of every game
     The first thing done for every request is to validate the player_id with the player_key using
         TWIML_codenames_API_Server.validate(player_id,player_key)
-    For the first 5 functions, returns are sent as bytes (using TWIML_codenames_API_Server.send_as_bytes) so objects
-        (e.g. numpy arrays or custom class obejcts) can be encoded
+    All endpoints are defined with plain 'def' (not 'async def'), so FastAPI runs them in its bounded worker threadpool.
+        This keeps the CPU-bound encoding in send_as_bytes (and the blocking pymongo calls) off the event loop. Do not
+        convert them to 'async def' without also moving that work off the loop
+    For the first 8 functions (root, turn, generate_clue, generate_guesses, log and logs), returns are sent as
+        MessagePack bytes (using TWIML_codenames_API_Server.send_as_bytes) so objects (e.g. numpy arrays or custom class
+        objects) can be encoded
+    The last 4 functions (games_by_player, completed_games, num_active_clients and leaderboards) only return plain
+        lists, dicts and numbers, so their returns are sent as JSON (using TWIML_codenames_API_Server.send_as_json, or
+        send_as_cached_json for completed_games and leaderboards, which may also send a 304 if the data has not changed)
 """
 
 import TWIML_codenames
 import TWIML_codenames_API_Server
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Query, Response
 # pydantic.BaseModel is used to define the expected variable types for the body of the post requests such that they are
 # properly recognized as the body:
 from pydantic import BaseModel
+from typing import List, Optional
 import uvicorn
 import os
 import config
@@ -46,6 +59,44 @@ class generate_guesses_body(BaseModel):
     """
     guesses: list
 
+class turn_body(BaseModel):
+    """
+    Defines the expected variable types for the body of the post(turn) request. All fields are optional: if the answer
+        for the player's role is not supplied, the inputs for the player's turn are returned instead
+    """
+    clue_word: Optional[str] = None
+    clue_count: Optional[int] = None
+    guesses: Optional[list] = None
+
+def clue_inputs(game_id):
+    """
+    @param game_id (int) : the ID of the game being queried
+
+    @returns (dict): the inputs the spymaster will need to generate a clue. See send_generate_clue_info
+    """
+    team_num, gameboard = gamelist[game_id].solicit_clue_inputs()
+    return {'game_id' : game_id,
+            'team_num' : team_num,
+            'gameboard' : gameboard
+            }
+
+def guesses_inputs(game_id):
+    """
+    @param game_id (int) : the ID of the game being queried
+
+    @returns (dict): the inputs the operative will need to generate a list of guesses. See send_generate_guesses_info
+    """
+    team_num, clue_word, clue_count, unguessed_words, boardwords, boardmarkers = \
+        gamelist[game_id].solicit_guesses_inputs()
+    return {'game_id' : game_id,
+            'team_num' : team_num,
+            'clue_word' : clue_word,
+            'clue_count' : clue_count,
+            'unguessed_words' : unguessed_words,
+            'boardwords' : boardwords,
+            'boardmarkers' : boardmarkers
+            }
+
 root="/"
 db=config.get_connection()
 
@@ -56,11 +107,14 @@ gamelist=TWIML_codenames_API_Server.Gamelist(clientlist)
 app = FastAPI() # called by uvicorn server_run:app
 
 @app.get(root)
-def get_player_status(player_id: int, player_key: int):
+def get_player_status(player_id: int, player_key: int, if_none_match: Optional[str] = Header(None)):
     """
     @params player_id, player_key : used for validating player identity
+    @param if_none_match (str)(optional) : the If-None-Match header. If it matches the ETag of the player's current
+        status, an empty 304 (Not Modified) response is returned instead of the status
 
-    @returns (bytes): the current status for the player containing info about active and ended games:
+    @returns (bytes): the current status for the player (along with its ETag) containing info about active and ended
+        games:
         info for active games includes:
             game_id, game start time, role_info (player's team number, player's role, and player's teammate ID),
             info about who the game is waiting on: the player_id of the player whose turn it is, their role, how long
@@ -81,7 +135,62 @@ def get_player_status(player_id: int, player_key: int):
         if clientlist.b_games_to_start:
             gamelist.new_game(clientlist.available_clients)
 
+        # The check for game timeouts are only called when players in that game check in. Check once here, for both the
+        #   ETag and the status:
+        client = clientlist[player_id]
+        gamelist.check_for_ended_games(client.active_games)
+
+        # if nothing has changed since the player last pulled their status, there is no need to send it again:
+        etag = client.status_etag(gamelist)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if if_none_match == etag:
+            return Response(status_code=304, headers=headers)
+
         # regardless if a new game has started or not, call the following function to determine what status to return
+        to_return = client.return_status(gamelist, b_check_ended_games=False)
+        return TWIML_codenames_API_Server.send_as_bytes(to_return, headers)
+    else:
+        return TWIML_codenames_API_Server.send_as_bytes({'ERROR':'incorrect player_id/player_key'})
+
+@app.post(root+"{game_id}/turn/")
+def take_turn(game_id: int, player_id: int, player_key: int, data: turn_body = None):
+    """
+    Handles a whole turn for either role through a single endpoint: the first call (without an answer) returns the
+        inputs for the player's turn, the second call carries the player's answer
+
+    @param game_id (int) : the ID of the game being queried
+    @params player_id, player_key : used for validating player identity
+    @param data (turn_body object)(optional) : This object contains either
+        clue_word (str) and clue_count (int) : if the player is the spymaster, or
+        guesses (list[str]) : if the player is the operative
+
+    @returns (bytes):
+        If it is the player's turn and no answer for their role was supplied:
+            role (str) : 'spymaster' or 'operative'
+            plus the inputs returned by get(generate_clue) or get(generate_guesses) for that role
+        Otherwise (including after the answer has been applied), returns the current status for this player
+    """
+    if TWIML_codenames_API_Server.validate(player_id, player_key):
+        # any time a client interacts with the server, record the touch (updating the last_active time for this client)
+        clientlist.client_touch(player_id)
+        if data is None:
+            data = turn_body()
+        if gamelist.is_active_game(game_id) and gamelist[game_id].is_players_turn(player_id):
+            role = gamelist[game_id].waiting_on
+            if role == 'spymaster':
+                if data.clue_word is not None and data.clue_count is not None:
+                    gamelist[game_id].clue_given(data.clue_word, data.clue_count)
+                else:
+                    to_return = clue_inputs(game_id)
+                    to_return['role'] = role
+                    return TWIML_codenames_API_Server.send_as_bytes(to_return)
+            else:
+                if data.guesses is not None:
+                    gamelist[game_id].guesses_given(data.guesses)
+                else:
+                    to_return = guesses_inputs(game_id)
+                    to_return['role'] = role
+                    return TWIML_codenames_API_Server.send_as_bytes(to_return)
         to_return = clientlist[player_id].return_status(gamelist)
         return TWIML_codenames_API_Server.send_as_bytes(to_return)
     else:
@@ -108,11 +217,7 @@ def send_generate_clue_info(game_id: int, player_id: int, player_key: int):
         clientlist.client_touch(player_id)
         if gamelist.is_active_game(game_id):
             if gamelist[game_id].is_players_turn(player_id):
-                team_num, gameboard = gamelist[game_id].solicit_clue_inputs()
-                to_return = {'game_id' : game_id,
-                             'team_num' : team_num,
-                             'gameboard' : gameboard
-                             }
+                to_return = clue_inputs(game_id)
                 return TWIML_codenames_API_Server.send_as_bytes(to_return)
             else:
                 to_return = clientlist[player_id].return_status(gamelist)
@@ -176,16 +281,7 @@ def send_generate_guesses_info(game_id: int, player_id: int, player_key: int):
         clientlist.client_touch(player_id)
         if gamelist.is_active_game(game_id):
             if gamelist[game_id].is_players_turn(player_id):
-                team_num, clue_word, clue_count, unguessed_words, boardwords, boardmarkers = \
-                    gamelist[game_id].solicit_guesses_inputs()
-                to_return = {'game_id' : game_id,
-                             'team_num' : team_num,
-                             'clue_word' : clue_word,
-                             'clue_count' : clue_count,
-                             'unguessed_words' : unguessed_words,
-                             'boardwords' : boardwords,
-                             'boardmarkers' : boardmarkers
-                             }
+                to_return = guesses_inputs(game_id)
                 return TWIML_codenames_API_Server.send_as_bytes(to_return)
             else:
                 to_return = clientlist[player_id].return_status(gamelist)
@@ -238,11 +334,39 @@ def get_game_log(game_id: int, player_id: int, player_key: int):
     if TWIML_codenames_API_Server.validate(player_id, player_key):
         # any time a client interacts with the server, record the touch (updating the last_active time for this client)
         clientlist.client_touch(player_id)
+        # the logs of in-progress games are buffered in memory; write out anything pending before reading the db:
+        if gamelist.is_active_game(game_id) and not gamelist[game_id].logger.flush(wait=True):
+            return TWIML_codenames_API_Server.send_as_bytes({'ERROR':f'game {game_id} log could not be written to the '
+                                                                      'db'})
         to_return=TWIML_codenames_API_Server.pull_game_log(game_id, player_id, db)
         return TWIML_codenames_API_Server.send_as_bytes(to_return)
     else:
         return TWIML_codenames_API_Server.send_as_bytes({'ERROR':'incorrect player_id/player_key'})
 
+@app.get(root+"logs/")
+def get_game_logs(player_id: int, player_key: int, game_ids: List[int] = Query(...)):
+    """
+    returns the game logs for several games at once
+    can be used for both completed and in-progress games
+
+    @params player_id, player_key : used for validating player identity
+    @param game_ids (list[int]) : the IDs of the games being queried
+
+    @returns (bytes): a dict of form {game_id : game log}
+    """
+    if TWIML_codenames_API_Server.validate(player_id, player_key):
+        # any time a client interacts with the server, record the touch (updating the last_active time for this client)
+        clientlist.client_touch(player_id)
+        # the logs of in-progress games are buffered in memory; write out anything pending before reading the db:
+        failed_game_ids = [game_id for game_id in game_ids
+                           if gamelist.is_active_game(game_id) and not gamelist[game_id].logger.flush(wait=True)]
+        to_return=TWIML_codenames_API_Server.pull_game_logs(game_ids, player_id, db)
+        for game_id in failed_game_ids:
+            to_return[game_id] = {'ERROR':f'game {game_id} log could not be written to the db'}
+        return TWIML_codenames_API_Server.send_as_bytes(to_return)
+    else:
+        return TWIML_codenames_API_Server.send_as_bytes({'ERROR':'incorrect player_id/player_key'})
+
 @app.get(root+"{player_to_pull}/games/")
 def get_games_by_player(player_to_pull:int):
     """
@@ -253,17 +377,23 @@ def get_games_by_player(player_to_pull:int):
     @returns (list): a list of the unique 6-digit ids for each game in the db that this player is/was involved in
         Note: unlike most other endpoints, this does not send the return as bytes
     """
-    return TWIML_codenames_API_Server.list_player_games(player_to_pull, db)
+    return TWIML_codenames_API_Server.send_as_json(TWIML_codenames_API_Server.list_player_games(player_to_pull, db))
 
 @app.get(root+"completed_games/")
-def get_completed_games():
+def get_completed_games(if_none_match: Optional[str] = Header(None)):
     """
     returns a list of game_ids for all completed games
 
+    @param if_none_match (str)(optional) : the ETag of a previously received response. If the list has not changed
+        since, an empty 304 (Not Modified) response is returned
+
     @returns (list): a list of the unique 6-digit identifiers for each completed game in the db.
         Note: unlike most other endpoints, this does not send the return as bytes
     """
-    return TWIML_codenames_API_Server.list_completed_games(db)
+    return TWIML_codenames_API_Server.send_as_cached_json('completed_games',
+                                                          TWIML_codenames_API_Server.completed_games_version,
+                                                          lambda: TWIML_codenames_API_Server.get_completed_games(db),
+                                                          if_none_match)
 
 @app.get(root+"num_active_clients/")
 def get_num_active_clients():
@@ -272,19 +402,25 @@ def get_num_active_clients():
 
     @returns (int) : a count of how many active clients are logged in to the server
     """
-    return len(clientlist.active_clients)
+    return TWIML_codenames_API_Server.send_as_json(clientlist.num_active_clients)
 
 @app.get(root+"leaderboards/")
-def get_leaderboards():
+def get_leaderboards(if_none_match: Optional[str] = Header(None)):
     """
     returns the current leaderboards
 
+    @param if_none_match (str)(optional) : the ETag of a previously received response. If the leaderboards have not
+        changed since, an empty 304 (Not Modified) response is returned
+
     @returns (dict) : a dict of format
         {'Spymasters' : list[(player_id,Elo)],
          'Operatives' : list[(player_id,Elo)],
          'Combined'   : list[(player_id,Elo)]}
     """
-    return TWIML_codenames_API_Server.get_leaderboards(db)
+    return TWIML_codenames_API_Server.send_as_cached_json('leaderboards',
+                                                          TWIML_codenames_API_Server.leaderboard_version,
+                                                          lambda: TWIML_codenames_API_Server.get_leaderboards(db),
+                                                          if_none_match)
 
 if __name__ == "__main__":
    PORT = int(os.environ.get("PORT",8000))